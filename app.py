@@ -1,21 +1,46 @@
 #$env:FLASK_APP = "app"
-from flask import Flask, request, render_template, redirect
+from flask import Flask, Response, request, render_template, redirect
 from flask_wtf import FlaskForm
 from flask_bootstrap import Bootstrap
 from wtforms import StringField, SubmitField, TextAreaField
 from wtforms.validators import DataRequired
-import pandas as pd 
 import json
 import io
+import zlib
+import hashlib
 import contextlib
+import os
 app = Flask(__name__)
 Bootstrap(app)
 app.config['SECRET_KEY'] = 's5TDW9C2ao'
 PATH_TO_DATA = "./data.csv"
+STREAM_ROWS = 50000 #rows per chunk of a streamed response
+# response formats, picked with the Accept header (csv when nothing else is asked for)
+FORMATS = ["text/csv", "application/vnd.apache.arrow.stream", "application/vnd.apache.parquet"]
 
-from custom_map_assignment import CustomDFAssigner
+from custom_map_assignment import CustomDFAssigner, CompiledMapSet, RunProfile, output_chunks
+from jobs import JobQueue
+from dataset_store import DatasetStore, PATH_TO_DATASETS
 
-df = pd.read_csv(PATH_TO_DATA)
+# versions of the data, never changed once saved: /set_data adds a version and /reset_data goes back to data.csv,
+# while a request keeps the frame it started with. Saved under DATASETS_PATH when set, else ./datasets/
+app.config['DATASETS_PATH'] = os.environ.get("DATASETS_PATH", PATH_TO_DATASETS)
+store = DatasetStore(app.config['DATASETS_PATH'])
+store.switch(store.add_base(PATH_TO_DATA))
+metrics = RunProfile().report() #report of the last run made with ?profile=1
+jobs = JobQueue(workers=2) #mappings submitted to /submit_mapping, cached by data version
+
+def set_data_frame(frame):
+    """
+    Save frame as a new version of the data and make it the current one
+    """
+    return store.switch(store.add_frame(frame))
+
+def snapshot():
+    """
+    The current frame and its version
+    """
+    return store.snapshot()
 
 from wtforms.widgets.core import TextArea
 class MyTextArea(TextArea):
@@ -38,18 +63,19 @@ def hello_world():
     message = ""
     if form.validate_on_submit():
         mapping = json.loads(form.mapping.data)
+        df, _ = snapshot()
         try:
             with contextlib.redirect_stderr(io.StringIO()) as f:
                 if isinstance(mapping, list):
                     if len(mapping):
-                        message = CustomDFAssigner("API").map_validator(df.copy(), mapping)
+                        message = CustomDFAssigner("API").map_validator(df, mapping)
                     else:
                         raise Exception("No mapping given")
                 elif isinstance(mapping, dict):
                     target = []
                     target.append(mapping)
                     if len(target) > 0:
-                        message = CustomDFAssigner("API").map_validator(df.copy(), target)
+                        message = CustomDFAssigner("API").map_validator(df, target)
                     else:
                         raise Exception("No mapping given")
                 else:
@@ -59,21 +85,137 @@ def hello_world():
             return f"Unexpected Error\n{str(err)}"
     return render_template('index.html', form=form, message=message)
 
+def profile_requested():
+    """
+    Whether the request asks for its run to be profiled (?profile=1), as profiling slows a run down
+    """
+    return request.args.get("profile", "").lower() in ["1", "true", "yes"]
+
+def profiled_run(data, mapping, progress=None, profile=False):
+    """
+    Run the mapping over data and return only the new_col and map_id columns.
+    With profile, the run's report is kept for /metrics.
+    """
+    global metrics
+    assigner = CustomDFAssigner("API")
+    if profile:
+        assigner.profile = RunProfile()
+    assigner.progress = progress
+    assigner.compact = "category"
+    output = assigner.evaluate(data, mapping)
+    if profile:
+        metrics = assigner.profile.report()
+    return output
+
+class ByteSink(object):
+    """
+    Write only file for the pyarrow writers, holding the bytes written until they are taken to be streamed
+    """
+    def __init__(self):
+        self.blocks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        self.blocks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self):
+        data = b"".join(self.blocks)
+        self.blocks = []
+        return data
+
+def frame_chunks(data, output=None):
+    """
+    Chunks of STREAM_ROWS rows of data, joined with the output columns when given (an empty data still gives its header)
+    """
+    if output is not None:
+        return output_chunks(data, output, STREAM_ROWS)
+    return (data.iloc[start:start + STREAM_ROWS] for start in range(0, max(len(data), 1), STREAM_ROWS))
+
+def encode_chunks(chunks, mimetype):
+    """
+    Yield the bytes of each chunk of rows in the given format, the header/schema with the first chunk
+    """
+    if mimetype == "text/csv":
+        for number, chunk in enumerate(chunks):
+            yield chunk.to_csv(index=False, header=number == 0).encode("utf-8")
+        return
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    sink = ByteSink()
+    writer = None
+    for chunk in chunks:
+        if writer is None:
+            table = pa.Table.from_pandas(chunk, preserve_index=False)
+            if mimetype == "application/vnd.apache.parquet":
+                writer = pq.ParquetWriter(sink, table.schema)
+            else:
+                writer = pa.ipc.new_stream(sink, table.schema)
+            schema = table.schema
+        else:
+            # later chunks are cast to the schema of the first one
+            table = pa.Table.from_pandas(chunk, schema=schema, preserve_index=False)
+        writer.write_table(table)
+        yield sink.take()
+    if writer is not None:
+        writer.close()
+    yield sink.take()
+
+def gzip_chunks(blocks):
+    """
+    Yield the blocks gzipped as one stream
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for block in blocks:
+        yield compressor.compress(block)
+    yield compressor.flush()
+
+def stream_frame(data, output=None):
+    """
+    Streamed response of data (joined with the output columns when given), a chunk of rows at a time,
+    in the format asked for by the Accept header and gzipped when the client accepts it
+    """
+    mimetype = request.accept_mimetypes.best_match(FORMATS, default="text/csv")
+    blocks = encode_chunks(frame_chunks(data, output), mimetype)
+    headers = {"Vary": "Accept, Accept-Encoding"}
+    if request.accept_encodings["gzip"]:
+        blocks = gzip_chunks(blocks)
+        headers["Content-Encoding"] = "gzip"
+    return Response(blocks, mimetype=mimetype, headers=headers)
+
+def run_output(data, mapping, progress=None, profile=False):
+    output = profiled_run(data, mapping, progress, profile)
+    if output is None:
+        raise Exception("Mapping couldn't be run")
+    return output
+
 @app.route("/run_mapping", methods=["POST"])
 def run_mapping():
-    global df
     try:
         mapping = request.json
         if isinstance(mapping, list):
             if len(mapping):
-                return (CustomDFAssigner("API").custom_assignment_processor(df.copy(), mapping)).to_csv(index=False)
+                data, _ = snapshot()
+                return stream_frame(data, run_output(data, mapping, profile=profile_requested()))
             else:
                 raise Exception("No mapping given")
         elif isinstance(mapping, dict):
             target = []
             target.append(mapping)
             if len(target):
-                return (CustomDFAssigner("API").custom_assignment_processor(df.copy(), target)).to_csv(index=False)
+                data, _ = snapshot()
+                return stream_frame(data, run_output(data, target, profile=profile_requested()))
             else:
                 raise Exception("No mapping given")
         else:
@@ -83,19 +225,19 @@ def run_mapping():
 
 @app.route("/validate_mapping", methods=["POST"])
 def validate():
-    global df
     try:
         mapping = request.json
+        df, _ = snapshot()
         if isinstance(mapping, list):
             if len(mapping):
-                return CustomDFAssigner("API").map_validator(df.copy(), mapping)
+                return CustomDFAssigner("API").map_validator(df, mapping)
             else:
                 raise Exception("No mapping given")
         elif isinstance(mapping, dict):
             target = []
             target.append(mapping)
             if len(target) > 0:
-                return CustomDFAssigner("API").map_validator(df.copy(), target)
+                return CustomDFAssigner("API").map_validator(df, target)
             else:
                 raise Exception("No mapping given")
         else:
@@ -103,24 +245,98 @@ def validate():
     except AssertionError as err:
         return f"Unexpected Error\n{str(err)}"
 
+@app.route("/explain_mapping", methods=["POST"])
+def explain():
+    try:
+        mapping = request.json
+        df, _ = snapshot()
+        if isinstance(mapping, dict):
+            mapping = [mapping]
+        if isinstance(mapping, list):
+            if len(mapping):
+                # explain doesn't change df, so it can run on the shared frame
+                report = CustomDFAssigner("API").explain(df, mapping)
+                if report is None:
+                    return {"error": "Error: mapping couldn't be explained"}, 400
+                return report
+            else:
+                raise Exception("No mapping given")
+        else:
+            return {"error": "Error: mapping couldn't be used"}, 415
+    except Exception as err:
+        return f"Unexpected Error\n{str(err)}"
+
+def mapping_hash(mapping):
+    """
+    Hash of what the engine runs for a mapping: its compiled maps in order, and the error of each map it rejects
+    """
+    map_set = CompiledMapSet(mapping)
+    compiled = [dict(map_set.maps[index], columns=sorted(map_set.maps[index]["columns"])) if index in map_set.maps else {"error": map_set.errors[index]}
+                for index in range(0, len(mapping))]
+    return hashlib.sha256(json.dumps(compiled, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+@app.route("/submit_mapping", methods=["POST"])
+def submit_mapping():
+    try:
+        mapping = request.json
+        if isinstance(mapping, dict):
+            mapping = [mapping]
+        if isinstance(mapping, list):
+            if len(mapping):
+                data, version = snapshot()
+                profile = profile_requested()
+                # profiled and plain runs of the same mapping are kept as separate jobs
+                job, cached = jobs.submit((version, mapping_hash(mapping), profile), lambda job: (data, run_output(data, mapping, job.progress, profile)))
+                return job.report(), 200 if cached else 202
+            else:
+                raise Exception("No mapping given")
+        else:
+            return {"error": "Error: mapping couldn't be used"}, 415
+    except Exception as err:
+        return f"Unexpected Error\n{str(err)}"
+
+@app.route("/job_status/<job_id>", methods=["GET"])
+def job_status(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return {"error": "Error: job not found"}, 404
+    return job.report()
+
+@app.route("/job_result/<job_id>", methods=["GET"])
+def job_result(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return {"error": "Error: job not found"}, 404
+    if job.status != "done":
+        return job.report(), 409
+    data, output = job.result
+    return stream_frame(data, output)
 
 @app.route("/set_data", methods=["POST"])
-#Just an idea, need to test
 def set_df():
-    global df
-    new_data = (request.data).decode("utf-8")
-    print(new_data)
-    readable_data = io.StringIO(new_data)
-    df = pd.read_csv(readable_data)
-    return "Data has been set"
+    # the upload is copied to disk as it comes in, and converted once
+    version = store.switch(store.add_csv(request.stream))
+    return f"Data has been set (version {version})"
+
+@app.route("/set_version/<int:version>", methods=["GET"])
+def set_version(version):
+    try:
+        store.switch(version)
+    except KeyError as err:
+        return {"error": f"Error: {err.args[0]}"}, 404
+    return f"Data has been set (version {version})"
 
 @app.route("/reset_data", methods=["GET"])
 def reset_df():
-    global df
-    df = pd.read_csv(PATH_TO_DATA)
+    store.reset()
     return "Data has been reset"
 
+@app.route("/metrics", methods=["GET"])
+def view_metrics():
+    global metrics
+    return metrics
+
 @app.route("/view_data", methods=["GET"])
 def view_df():
-    global df
-    return df.to_csv(index=False)
\ No newline at end of file
+    data, _ = snapshot()
+    return stream_frame(data)
\ No newline at end of file
@@ -0,0 +1,374 @@
+import pandas as pd
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import string
+import subprocess
+import tempfile
+import time
+
+from custom_map_assignment import CustomDFAssigner, APPROVED_LOGIC
+
+def best_time(func, repeat=3):
+    """
+    Run func repeat times and return (fastest wall time in seconds, last result).
+    Tracebacks printed by func (e.g. map conflicts found by the validator) are kept out of the report.
+    """
+    best = None
+    for _ in range(repeat):
+        with contextlib.redirect_stderr(io.StringIO()):
+            start = time.perf_counter()
+            result = func()
+            elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def random_words(rng, count, length=6):
+    return ["".join(rng.choice(string.ascii_lowercase) for _ in range(length)) for _ in range(count)]
+
+def generate_frame(rows=100000, columns=4, cardinality=1000, length=12, seed=0):
+    """
+    Build a df of string columns C0..C{columns-1}, each holding cardinality distinct values
+    of about length characters (space separated words) spread over rows rows
+    """
+    rng = random.Random(seed)
+    data = {}
+    for col in range(0, columns):
+        vocabulary = [" ".join(random_words(rng, max(1, length // 6), 5))[:length] for _ in range(cardinality)]
+        data[f"C{col}"] = [rng.choice(vocabulary) for _ in range(rows)]
+    return pd.DataFrame(data)
+
+def generate_value(rng, df, logic):
+    """
+    Pick a key and a value from df for the given logic: a whole value for (not_)equals,
+    a piece of one for (not_)contains and a prefix for starts_with
+    """
+    key = rng.choice(list(df.columns))
+    text = df[key].iloc[rng.randrange(len(df))]
+    if logic in ["contains", "not_contains"]:
+        start = rng.randrange(max(1, len(text) - 3))
+        text = text[start:start + 4]
+    elif logic == "starts_with":
+        text = text[:rng.randint(1, max(1, len(text) // 2))]
+    return key, text
+
+def generate_query(rng, df, logic_mix, list_size):
+    logic = rng.choices(list(logic_mix.keys()), weights=list(logic_mix.values()))[0]
+    key, value = generate_value(rng, df, logic)
+    if list_size > 1:
+        value = [value] + [generate_value(rng, df[[key]], logic)[1] for _ in range(list_size - 1)]
+    return {"key": key, "logic": logic, "value": value}
+
+def generate_map_set(df, maps=200, logic_mix=None, list_size=1, depth=0, post_run=0, seed=0):
+    """
+    Build a map set over the columns of df.
+    logic_mix weights the logic of each query (all approved logic equally by default), list_size is the number
+    of values per query, depth the number of associated queries per map, and post_run how many of the
+    levels (L1, L2) the maps are spread over.
+    """
+    rng = random.Random(seed)
+    logic_mix = logic_mix or dict((logic, 1) for logic in APPROVED_LOGIC)
+    levels = [None] + ["L1", "L2"][:post_run]
+    map_set = []
+    for i in range(0, maps):
+        map_json_elem = generate_query(rng, df, logic_mix, list_size)
+        map_json_elem["assign_to"] = f"group {i}"
+        map_json_elem["associated_query"] = [generate_query(rng, df, logic_mix, list_size) for _ in range(depth)]
+        level = rng.choice(levels)
+        if level is not None:
+            map_json_elem["post_run"] = level
+        map_set.append(map_json_elem)
+    return map_set
+
+def write_map_sets(map_sets):
+    """
+    Write {env: map set} as json files to a new temporary folder and return its path
+    """
+    folder = tempfile.mkdtemp()
+    for env, map_set in map_sets.items():
+        with open(os.path.join(folder, env + ".json"), "w") as f:
+            json.dump(map_set, f)
+    return folder + "/"
+
+def same_assignments(expected, result):
+    return bool(all(expected[col].astype(str).equals(result[col].astype(str)) for col in ["new_col", "map_id"]))
+
+def bench_start_processing(rows=200000, columns=4, cardinality=1000, length=12, maps=200, list_size=2, depth=1, post_run=2, repeat=3, seed=0):
+    """
+    Time start_processing on a generated map file, for the first (compiling) run and for repeat runs
+    """
+    df = generate_frame(rows, columns, cardinality, length, seed)
+    folder = write_map_sets({"bench": generate_map_set(df, maps, list_size=list_size, depth=depth, post_run=post_run, seed=seed)})
+    first, _ = best_time(lambda: CustomDFAssigner("bench", maps_loc=folder).start_processing(df.copy()), repeat=1)
+    seconds, _ = best_time(lambda: CustomDFAssigner("bench", maps_loc=folder).start_processing(df.copy()), repeat)
+    return {
+        "benchmark": "start_processing",
+        "params": {"rows": rows, "columns": columns, "cardinality": cardinality, "length": length, "maps": maps, "list_size": list_size, "depth": depth, "post_run": post_run},
+        "seconds": {"first_run": first, "repeat_run": seconds},
+    }
+
+def bench_map_validator(maps=1000, list_size=1, depth=1, repeat=3, seed=0):
+    """
+    Time map_validator on a whole generated map set
+    """
+    df = generate_frame(1000, seed=seed)
+    map_set = generate_map_set(df, maps, list_size=list_size, depth=depth, seed=seed)
+    seconds, _ = best_time(lambda: CustomDFAssigner("bench").map_validator(df, map_set), repeat)
+    return {
+        "benchmark": "map_validator",
+        "params": {"maps": maps, "list_size": list_size, "depth": depth},
+        "seconds": {"validate": seconds},
+    }
+
+def bench_duplicate_mappings_check(files=10, maps=100, repeat=3, seed=0):
+    """
+    Time duplicate_mappings_check over a folder of generated map files
+    """
+    df = generate_frame(1000, seed=seed)
+    folder = write_map_sets(dict((f"env{i}", generate_map_set(df, maps, depth=1, seed=seed + i)) for i in range(0, files)))
+    seconds, _ = best_time(lambda: CustomDFAssigner("bench").duplicate_mappings_check(folder), repeat)
+    return {
+        "benchmark": "duplicate_mappings_check",
+        "params": {"files": files, "maps": maps},
+        "seconds": {"check": seconds},
+    }
+
+def bench_endpoints(rows=50000, maps=100, repeat=3, seed=0):
+    """
+    Time the Flask endpoints through the test client on a generated dataset
+    """
+    # the data versions saved by the app go to a scratch folder
+    os.environ["DATASETS_PATH"] = tempfile.mkdtemp()
+    import app
+    df = generate_frame(rows, seed=seed)
+    map_set = generate_map_set(df, maps, depth=1, seed=seed)
+    app.set_data_frame(df)
+    body = df.to_csv(index=False).encode("utf-8")
+    client = app.app.test_client()
+    timings = {}
+    for name, call in [
+        # streamed responses are only built as they are read
+        ("validate_mapping", lambda: client.post("/validate_mapping", json=map_set).data),
+        ("run_mapping", lambda: client.post("/run_mapping", json=map_set).data),
+        ("run_mapping_gzip", lambda: client.post("/run_mapping", json=map_set, headers={"Accept-Encoding": "gzip"}).data),
+        ("run_mapping_arrow", lambda: client.post("/run_mapping", json=map_set, headers={"Accept": "application/vnd.apache.arrow.stream"}).data),
+        ("view_data", lambda: client.get("/view_data").data),
+        # these two change the current data, so they go last
+        ("set_data", lambda: client.post("/set_data", data=body).data),
+        ("reset_data", lambda: client.get("/reset_data").data),
+    ]:
+        timings[name], _ = best_time(call, repeat)
+    return {
+        "benchmark": "endpoints",
+        "params": {"rows": rows, "maps": maps},
+        "seconds": timings,
+    }
+
+def bench_contains(rows=200000, patterns=400, distinct=20000, repeat=3, seed=0):
+    """
+    Time a map set of many contains rules on one free text column, checking every value
+    once per rule (per map path) against one scan per distinct value (matcher path)
+    """
+    rng = random.Random(seed)
+    vocabulary = random_words(rng, 2000)
+    texts = [" ".join(rng.choice(vocabulary) for _ in range(8)) for _ in range(distinct)]
+    df = pd.DataFrame({"Description": [rng.choice(texts) for _ in range(rows)]})
+    maps = [{"key": "Description", "logic": "contains", "value": word, "assign_to": f"group {i}"}
+            for i, word in enumerate(rng.sample(vocabulary, patterns))]
+
+    def run(multi_pattern, use_matcher=None):
+        assigner = CustomDFAssigner("bench")
+        assigner.multi_pattern = multi_pattern
+        if use_matcher is not None:
+            # skip the cost based choice, to time each path on its own
+            assigner.use_matcher = lambda df, key, matcher: use_matcher
+        return assigner.custom_assignment_processor(df.copy(), maps)
+
+    per_map, expected = best_time(lambda: run(False), repeat)
+    matcher, result = best_time(lambda: run(True, True), repeat)
+    chosen, chosen_result = best_time(lambda: run(True), repeat)
+    return {
+        "benchmark": "contains",
+        "params": {"rows": rows, "patterns": patterns, "distinct_values": distinct},
+        "seconds": {"per_map": per_map, "matcher": matcher, "chosen": chosen},
+        "same_result": same_assignments(expected, result) and same_assignments(expected, chosen_result),
+    }
+
+def bench_contains_distinct(rows=200000, patterns=8, repeat=3, seed=0):
+    """
+    bench_contains on a column where nearly every row has its own value, so the matcher has as many values to scan as
+    the per map path has rows, and only pays off with many more patterns
+    """
+    result = bench_contains(rows=rows, patterns=patterns, distinct=rows, repeat=repeat, seed=seed)
+    result["benchmark"] = "contains_distinct"
+    return result
+
+def bench_categorical(rows=1000000, distinct=200, maps=100, repeat=3, seed=0):
+    """
+    Time a mixed map set on high row, low cardinality data through the row by row string path,
+    categorical key columns, and string columns with CustomDFAssigner.categorical set
+    """
+    rng = random.Random(seed)
+    titles = random_words(rng, distinct)
+    texts = [" ".join(rng.choice(titles) for _ in range(5)) for _ in range(distinct)]
+    df = pd.DataFrame({"Title": [rng.choice(titles) for _ in range(rows)], "Description": [rng.choice(texts) for _ in range(rows)]})
+    logics = ["equals", "not_equals", "contains", "starts_with"]
+    mapping = [{"key": rng.choice(["Title", "Description"]), "logic": logics[i % len(logics)], "value": rng.choice(titles)[:4 if i % 4 == 3 else 6],
+                "assign_to": f"group {i}", "associated_query": [{"key": "Title", "logic": "not_contains", "value": rng.choice(titles)}]}
+               for i in range(maps)]
+    categorical_df = df.astype("category")
+
+    def run(frame, categorical):
+        assigner = CustomDFAssigner("bench")
+        # compare the per predicate paths only
+        assigner.multi_pattern = False
+        assigner.categorical = categorical
+        return assigner.custom_assignment_processor(frame.copy(), mapping)
+
+    string_path, expected = best_time(lambda: run(df, False), repeat)
+    categorical_dtype, by_dtype = best_time(lambda: run(categorical_df, False), repeat)
+    categorical_flag, by_flag = best_time(lambda: run(df, True), repeat)
+    return {
+        "benchmark": "categorical",
+        "params": {"rows": rows, "distinct_values": distinct, "maps": maps},
+        "seconds": {"string": string_path, "categorical_dtype": categorical_dtype, "categorical_flag": categorical_flag},
+        "same_result": same_assignments(expected, by_dtype) and same_assignments(expected, by_flag),
+    }
+
+def bench_parallel(rows=400000, maps=200, partition_size=50000, workers=(1, 2, 4), repeat=1, seed=0):
+    """
+    Time parallel_assignment_processor for each worker count, giving the scaling curve
+    """
+    rng = random.Random(seed)
+    vocabulary = random_words(rng, 500)
+    df = pd.DataFrame({
+        "Title": [rng.choice(vocabulary) for _ in range(rows)],
+        "Description": [" ".join(rng.choice(vocabulary) for _ in range(6)) for _ in range(rows)],
+    })
+    mapping = [{"key": "Description", "logic": "contains", "value": word, "assign_to": f"group {i}",
+                "associated_query": [{"key": "Title", "logic": "not_equals", "value": rng.choice(vocabulary)}]}
+               for i, word in enumerate(rng.sample(vocabulary, maps))]
+    timings = {}
+    same_result = True
+    expected = None
+    for count in workers:
+        timings[f"workers_{count}"], result = best_time(lambda: CustomDFAssigner("bench").parallel_assignment_processor(df.copy(), mapping, count, partition_size), repeat)
+        expected = result if expected is None else expected
+        same_result = same_result and same_assignments(expected, result)
+    return {
+        "benchmark": "parallel",
+        "params": {"rows": rows, "maps": maps, "partition_size": partition_size, "cpu_count": os.cpu_count()},
+        "seconds": timings,
+        "same_result": same_result,
+    }
+
+def bench_explain(rows=1000000, maps=1000, repeat=1, seed=0):
+    """
+    Time the explain dry run (per map bitsets, wins, shadows and pairwise overlaps) against a plain run of the same map set
+    """
+    df = generate_frame(rows, seed=seed)
+    map_set = generate_map_set(df, maps, depth=1, post_run=1, seed=seed)
+    run, _ = best_time(lambda: CustomDFAssigner("bench").custom_assignment_processor(df.copy(), map_set), repeat)
+    explain, report = best_time(lambda: CustomDFAssigner("bench").explain(df, map_set), repeat)
+    return {
+        "benchmark": "explain",
+        "params": {"rows": rows, "maps": maps, "overlapping_pairs": len(report["overlaps"])},
+        "seconds": {"run": run, "explain": explain},
+    }
+
+def bench_incremental(rows=1000000, maps=200, changed=0.01, repeat=3, seed=0):
+    """
+    Time incremental_processing after a changed fraction of the rows (half changed, half appended) against a full run
+    """
+    df = generate_frame(rows, seed=seed)
+    folder = write_map_sets({"bench": generate_map_set(df, maps, depth=1, post_run=2, seed=seed)})
+    state_path = os.path.join(folder, "state.pkl")
+    CustomDFAssigner("bench", maps_loc=folder).incremental_processing(df.copy(), state_path=state_path)
+    count = int(rows * changed / 2)
+    updated = df.copy()
+    positions = random.Random(seed).sample(range(0, rows), count)
+    updated.iloc[positions, 0] = updated.iloc[positions[::-1], 0].to_numpy()
+    appended = generate_frame(count, seed=seed + 1)
+    appended.index = pd.RangeIndex(rows, rows + count)
+    updated = pd.concat([updated, appended])
+    full, _ = best_time(lambda: CustomDFAssigner("bench", maps_loc=folder).start_processing(updated.copy()), repeat)
+    # the state file isn't saved again, so every repeat starts from the same previous run
+    incremental, _ = best_time(lambda: CustomDFAssigner("bench", maps_loc=folder).incremental_processing(updated.copy(), previous=state_path), repeat)
+    return {
+        "benchmark": "incremental",
+        "params": {"rows": rows, "maps": maps, "changed": changed},
+        "seconds": {"full": full, "incremental": incremental},
+    }
+
+# name: (benchmark, smaller arguments used with --quick)
+BENCHMARKS = {
+    "start_processing": (bench_start_processing, {"rows": 20000, "maps": 50}),
+    "map_validator": (bench_map_validator, {"maps": 200}),
+    "duplicate_mappings_check": (bench_duplicate_mappings_check, {"files": 3, "maps": 30}),
+    "endpoints": (bench_endpoints, {"rows": 5000, "maps": 20}),
+    "contains": (bench_contains, {"rows": 20000, "patterns": 100, "distinct": 2000, "repeat": 1}),
+    "contains_distinct": (bench_contains_distinct, {"rows": 20000, "repeat": 1}),
+    "categorical": (bench_categorical, {"rows": 100000, "repeat": 1}),
+    "parallel": (bench_parallel, {"rows": 40000, "maps": 50, "partition_size": 10000}),
+    "explain": (bench_explain, {"rows": 20000, "maps": 50}),
+    "incremental": (bench_incremental, {"rows": 20000, "maps": 50, "repeat": 1}),
+}
+
+def current_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+def run_benchmarks(names=None, quick=False):
+    """
+    Run the named benchmarks (all of them by default) and return the report as a dict
+    """
+    results = []
+    for name in (names or list(BENCHMARKS.keys())):
+        bench, quick_args = BENCHMARKS[name]
+        results.append(bench(**(quick_args if quick else {})))
+    return {
+        "commit": current_commit(),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "quick": quick,
+        "results": results,
+    }
+
+def compare(old, new):
+    """
+    Return one line per timing found in both reports, with the new/old time ratio
+    """
+    def timings(report):
+        found = {}
+        for result in report["results"]:
+            for name, seconds in result["seconds"].items():
+                found[(result["benchmark"], json.dumps(result["params"], sort_keys=True), name)] = seconds
+        return found
+    old_timings = timings(old)
+    lines = []
+    for key, seconds in timings(new).items():
+        if key in old_timings and old_timings[key]:
+            lines.append(f"{key[0]} {key[2]} {key[1]}: {old_timings[key]:.4f}s -> {seconds:.4f}s ({seconds / old_timings[key]:.2f}x)")
+    return lines
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the assignment engine on generated data and print the results as json")
+    parser.add_argument("names", nargs="*", help="benchmarks to run, out of: " + ", ".join(BENCHMARKS.keys()) + " (all by default)")
+    parser.add_argument("--quick", action="store_true", help="use small sizes")
+    parser.add_argument("--output", help="also write the json report to this file")
+    parser.add_argument("--compare", help="json report of an earlier run to compare the timings against")
+    args = parser.parse_args()
+    report = run_benchmarks(args.names, args.quick)
+    print(json.dumps(report, indent=4))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=4)
+    if args.compare:
+        with open(args.compare, "r") as f:
+            print("\n".join(compare(json.load(f), report)))
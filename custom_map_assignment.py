@@ -1,117 +1,1171 @@
 import pandas as pd 
+import numpy as np
 import json
 import os
+import hashlib
+import time
 import traceback
-from copy import copy
+from concurrent.futures import ProcessPoolExecutor
+from copy import deepcopy
+from bisect import bisect_left
+from matchers import AhoCorasick, PrefixIndex
 
 PATH_TO_MAPS = "./mappings/"
+APPROVED_LOGIC = ["contains","equals","not_equals","not_contains", "starts_with"]
+MIN_MATCHER_PATTERNS = 8 #fewer contains values than this on a key are always cheaper to check one by one
+MATCHER_COST = 25 #scanning a distinct value with the matcher costs about as much as checking this many rows for one contains value
+SAMPLE_ROWS = 1000 #rows sampled to estimate how selective a predicate is
+
+# compiled map sets, keyed by absolute path of the map file
+_MAP_SET_CACHE = {}
+# map fingerprints of map files, keyed by absolute path of the map file
+_FINGERPRINT_CACHE = {}
+
+def normalize_query(map_config):
+    """
+    Return a copy of a map (or associated query) with its logic and value lowercased and stripped
+    """
+    query = dict(map_config)
+    query["logic"] = map_config["logic"].lower().strip()
+    if isinstance(map_config["value"], list):
+        query["value"] = list(map(str.strip, map(str.lower, map_config["value"])))
+    else:
+        query["value"] = map_config["value"].lower().strip()
+    return query
+
+def canonical_map(map_config):
+    """
+    Return a copy of a map that is the same for maps the engine runs the same way: logic and values normalized (see normalize_query),
+    and value lists and associated queries sorted. Maps that fail check_map_fields, which the engine doesn't run, are kept as they are.
+    """
+    try:
+        check_map_fields(map_config, "")
+        canonical = normalize_query(map_config)
+    except Exception:
+        return map_config
+    if isinstance(canonical["value"], list):
+        canonical["value"] = sorted(set(canonical["value"]))
+    if isinstance(canonical.get("associated_query"), list):
+        canonical["associated_query"] = sorted((canonical_map(child) for child in canonical["associated_query"]), key=lambda child: json.dumps(child, sort_keys=True, default=str))
+    return canonical
+
+def map_fingerprint(map_config):
+    """
+    Return a hash of the canonical form of a map (see canonical_map)
+    """
+    return hashlib.sha256(json.dumps(canonical_map(map_config), sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+def file_fingerprints(path, saved=None):
+    """
+    Return the fingerprints of the maps in a map file, only reading the file again when its size or mtime has changed.
+    saved holds fingerprints from an earlier run (abspath -> {"mtime", "size", "fingerprints"}) to reuse as well.
+    """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    for cached in [_FINGERPRINT_CACHE.get(path), (saved or {}).get(path)]:
+        if cached is not None and cached["mtime"] == stat.st_mtime_ns and cached["size"] == stat.st_size:
+            _FINGERPRINT_CACHE[path] = cached
+            return cached["fingerprints"]
+    with open(path, "r") as f:
+        mappings = json.loads(f.read())
+    _FINGERPRINT_CACHE[path] = {"mtime": stat.st_mtime_ns, "size": stat.st_size, "fingerprints": [map_fingerprint(map_config) for map_config in mappings]}
+    return _FINGERPRINT_CACHE[path]["fingerprints"]
+
+def predicate_key(query):
+    """
+    Return (logic, key, value) for a normalized map or associated query, with list values as tuples so it can be hashed
+    """
+    value = query["value"]
+    return (query["logic"], query["key"], tuple(value) if isinstance(value, list) else value)
+
+def check_map_fields(key, location):
+    """
+    Assert that a single map (and its associated queries) has every required field and an approved logic
+    """
+    assert ("key" in list(key.keys())), "Key Missing" + location
+    assert ("logic" in list(key.keys())), "Logic Missing" + location
+    assert ("value" in list(key.keys())), "Value Missing" + location
+    assert ("assign_to" in list(key.keys())), "assign_to Missing" + location
+    assert (key["logic"].lower() in APPROVED_LOGIC), "Logic is not valid" + location
+    if ("associated_query" in list(key.keys())) and (len(key["associated_query"])):
+        for i in range(0,len(key["associated_query"])):
+            child = key["associated_query"][i]
+            assert ("key" in list(child.keys())), "Associated query key is missing" + location + f"(query at index {i})"
+            assert ("logic" in list(child.keys())), "Associated query logic is missing" + location + f"(query at index {i})"
+            assert ("value" in list(child.keys())), "Associated query value is missing" + location + f"(query at index {i})"
+            assert (child["logic"].lower() in APPROVED_LOGIC), "Associated query logic is not valid" + location + f"(query at index {i})"
+
+def find_conflicts(mappings):
+    """
+    Return the (i, j) pairs, i < j, where mappings[i]['value'] in mappings[j]['value'] and mappings[i]['key'] in mappings[j]['key'],
+    in the order a pairwise scan finds them.
+    String values are looked up in a hash set (a string in a list) and in one Aho-Corasick automaton (a string in a string),
+    so the time grows with the number of maps and conflicts instead of the number of pairs.
+    """
+    values = [map_json_elem["value"] for map_json_elem in mappings]
+    keys = [map_json_elem["key"] for map_json_elem in mappings]
+    indexed = all(isinstance(key, str) for key in keys) and all(
+        isinstance(value, str) or (isinstance(value, list) and all(isinstance(item, str) for item in value)) for value in values)
+    if not indexed:
+        return [(i, j) for i in range(0, len(mappings) - 1) for j in range(i + 1, len(mappings))
+                if mappings[i]['value'] in mappings[j]['value'] and mappings[i]['key'] in mappings[j]['key']]
+
+    # a list value can't be looked for in a later string value, which raises the same TypeError as the pairwise scan
+    later_string = None
+    for i in reversed(range(0, len(values))):
+        if isinstance(values[i], list) and later_string is not None:
+            values[i] in values[later_string]
+        if isinstance(values[i], str):
+            later_string = i
+
+    # string value -> key -> indices of the maps with that value and key, in order
+    by_value = {}
+    for i, value in enumerate(values):
+        if isinstance(value, str):
+            by_value.setdefault(value, {}).setdefault(keys[i], []).append(i)
+    # the keys each key contains
+    containing = dict((key, [other for other in set(keys) if other in key]) for key in set(keys))
+    matcher = AhoCorasick(by_value.keys())
+
+    conflicts = []
+    for j, value in enumerate(values):
+        if isinstance(value, str):
+            found = [matcher.patterns[p] for p in matcher.search(value)]
+        else:
+            # a string is in a list when it equals one of its items (and a list is never an item of a list of strings)
+            found = [item for item in set(value) if item in by_value]
+        for pattern in found:
+            for key in containing[keys[j]]:
+                indices = by_value[pattern].get(key, [])
+                conflicts.extend((i, j) for i in indices[:bisect_left(indices, j)])
+    return sorted(conflicts)
+
+class CompiledMapSet(object):
+    """
+    A map set that has been validated and normalized once so it can be run many times.
+    Maps that fail validation are kept out of self.maps and recorded in self.errors.
+    """
+    def __init__(self, maps_found_list, path=None, digest=None, mtime=None, size=None):
+        self.path = path
+        self.digest = digest
+        self.mtime = mtime
+        self.size = size
+        self.raw = maps_found_list
+        self.maps = {}
+        self.errors = {}
+        self._ids = {}
+        self._invalid = {}
+        self._dispatch = {}
+        self._conflicts = None
+        self._schedule = {}
+        for index in range(0, len(maps_found_list)):
+            map_json_elem = maps_found_list[index]
+            try:
+                check_map_fields(map_json_elem, f"\n{index}: {map_json_elem}")
+                compiled = normalize_query(map_json_elem)
+                compiled["associated_query"] = [normalize_query(child) for child in map_json_elem.get("associated_query", [])]
+                compiled["columns"] = set([compiled["key"]] + [child["key"] for child in compiled["associated_query"]])
+                self.maps[index] = compiled
+            except Exception as e:
+                self.errors[index] = str(e)
+        # every df column a map reads
+        self.columns = sorted(set(key for map_json_elem in self.maps.values() for key in map_json_elem["columns"]))
+        # how many maps and associated queries (over all levels) use each distinct predicate, see predicate_key
+        self.predicates = {}
+        for map_json_elem in self.maps.values():
+            for query in [map_json_elem] + map_json_elem["associated_query"]:
+                predicate = predicate_key(query)
+                self.predicates[predicate] = self.predicates.get(predicate, 0) + 1
+        # all contains/not_contains values on a key are found with one scan of each value (see matchers.AhoCorasick)
+        patterns = {}
+        prefixes = {}
+        for map_json_elem in self.maps.values():
+            for query in [map_json_elem] + map_json_elem["associated_query"]:
+                value = query["value"]
+                if query["logic"] in ["contains", "not_contains"]:
+                    patterns.setdefault(query["key"], []).extend(value if isinstance(value, list) else [value])
+                elif query["logic"] == "starts_with":
+                    prefixes.setdefault(query["key"], []).extend(value if isinstance(value, list) else [value])
+        self.matchers = dict((key, AhoCorasick(values)) for key, values in patterns.items() if len(set(values)) >= MIN_MATCHER_PATTERNS)
+        # keys with several starts_with values are checked through a sorted index of the column's distinct values (see matchers.PrefixIndex)
+        self.prefix_keys = set(key for key, values in prefixes.items() if len(set(values)) > 1)
+        self.assign_to = np.array([self.maps[index]["assign_to"] if index in self.maps else None for index in range(0, len(maps_found_list))], dtype=object)
+
+    def __len__(self):
+        return len(self.raw)
+
+    def map_ids(self, env):
+        """
+        Return the map ids ({env}_{index}) for this map set, as an array indexed by map position
+        """
+        if env not in self._ids:
+            self._ids[env] = np.array([f"{env}_{index}" for index in range(0, len(self.raw))], dtype=object)
+        return self._ids[env]
+
+    def conflicts(self):
+        """
+        Return the conflicting map pairs of the raw maps (see find_conflicts), only worked out once per map set
+        """
+        if self._conflicts is None:
+            self._conflicts = find_conflicts(self.raw)
+        return self._conflicts
+
+    def dispatch(self, indices):
+        """
+        Split the maps of one level into maps that have to be run one by one and groups of
+        equals or starts_with maps without associated queries on the same key, keyed by (logic, key).
+        An equals group is a lookup of value -> first map index, a starts_with group a list of (prefix, map index).
+        """
+        signature = tuple(indices)
+        if signature not in self._dispatch:
+            by_key = {}
+            for index in indices:
+                map_json_elem = self.maps[index]
+                if map_json_elem["logic"] in ["equals", "starts_with"] and len(map_json_elem["associated_query"]) == 0 and map_json_elem["assign_to"] != 'unknown':
+                    by_key.setdefault((map_json_elem["logic"], map_json_elem["key"]), []).append(index)
+            groups = {}
+            grouped = set()
+            for (logic, key), members in by_key.items():
+                # a single map is just as fast run on its own
+                if len(members) < 2:
+                    continue
+                items = []
+                for index in members:
+                    value = self.maps[index]["value"]
+                    items.extend((item, index) for item in (value if isinstance(value, list) else [value]))
+                if logic == "equals":
+                    lookup = {}
+                    for item, index in items:
+                        lookup.setdefault(item, index)
+                    groups[(logic, key)] = lookup
+                else:
+                    groups[(logic, key)] = items
+                grouped.update(members)
+            singles = [index for index in indices if index not in grouped]
+            self._dispatch[signature] = (singles, groups)
+        return self._dispatch[signature]
+
+    def invalid_maps(self, columns, levels):
+        """
+        Return the indices of maps that can't be run against a df with the given columns
+        """
+        signature = (tuple(columns), tuple(levels))
+        if signature not in self._invalid:
+            cols = set(columns)
+            invalid = []
+            for index in range(0, len(self.raw)):
+                if index in self.errors:
+                    invalid.append(index)
+                elif not self.maps[index]["columns"] <= cols:
+                    invalid.append(index)
+                elif "post_run" in self.maps[index] and self.maps[index]["post_run"] not in levels:
+                    invalid.append(index)
+            self._invalid[signature] = invalid
+        return self._invalid[signature]
+
+    def schedule(self, columns, levels):
+        """
+        Return the maps that can be run against a df with the given columns, bucketed by level in the order the buckets run:
+        (None, maps without a post_run) first, then (level, maps with that post_run) for each of levels
+        """
+        signature = (tuple(columns), tuple(levels))
+        if signature not in self._schedule:
+            invalid = set(self.invalid_maps(columns, levels))
+            buckets = dict((level, []) for level in [None] + list(levels))
+            for index in sorted(self.maps):
+                if index not in invalid:
+                    buckets[self.maps[index].get("post_run")].append(index)
+            self._schedule[signature] = list(buckets.items())
+        return self._schedule[signature]
+
+class ColumnCache(object):
+    """
+    Lowercased copies of the df columns used by the maps, so each column is only lowercased once per run.
+    Counts how often a lowercased column was reused (hits) or had to be built (misses).
+    """
+    def __init__(self):
+        self.df = None
+        self.columns = {}
+        self.derived = {}
+        self.hits = 0
+        self.misses = 0
+
+    def bind(self, df):
+        """
+        Start caching for a new run over df, dropping anything cached for another frame
+        """
+        self.df = df
+        self.columns = {}
+        self.derived = {}
+        self.hits = 0
+        self.misses = 0
+
+    def release(self):
+        """
+        Stop caching once the run is over, keeping the hit and miss counts
+        """
+        self.df = None
+        self.columns = {}
+        self.derived = {}
+
+    def invalidate(self, keys):
+        """
+        Drop cached columns whose values in the bound df have changed
+        """
+        for key in keys:
+            self.columns.pop(key, None)
+            for kind, derived_key in list(self.derived.keys()):
+                if derived_key == key:
+                    del self.derived[(kind, derived_key)]
+
+    def lower(self, df, key):
+        """
+        Return df[key] lowercased, reusing the cached copy when df is (a slice of) the bound df
+        """
+        if self.df is None or not (df is self.df or self.df.index.is_unique):
+            return df[key].str.lower()
+        if key in self.columns:
+            self.hits += 1
+        else:
+            self.misses += 1
+            self.columns[key] = self.df[key].str.lower()
+        if df is self.df:
+            return self.columns[key]
+        return self.columns[key].loc[df.index]
+
+    def derive(self, df, key, kind, build):
+        """
+        Return build(), something computed from df[key], only building it once per run for the bound df
+        """
+        if self.df is None or df is not self.df:
+            return build()
+        if (kind, key) not in self.derived:
+            self.derived[(kind, key)] = build()
+        return self.derived[(kind, key)]
+
+    def has(self, key, kind):
+        """
+        Whether something derived from df[key] has already been built this run
+        """
+        return (kind, key) in self.derived
+
+    def discard(self, key, kind):
+        """
+        Drop something derived from df[key] that won't be needed again this run
+        """
+        self.derived.pop((kind, key), None)
+
+    def coded(self, df, key):
+        """
+        Return (codes, values) for df[key]: values holds its distinct values lowercased, followed by a missing value,
+        and codes the position in values of each row's value (missing values point at the trailing one).
+        Categorical columns reuse their categories and codes.
+        """
+        def build():
+            column = df[key]
+            if isinstance(column.dtype, pd.CategoricalDtype):
+                codes, uniques = column.cat.codes.to_numpy(), column.cat.categories
+            else:
+                codes, uniques = pd.factorize(column)
+            values = pd.Series(np.append(uniques.str.lower().to_numpy(dtype=object), np.nan), dtype=object)
+            return np.where(codes < 0, len(uniques), codes), values
+        return self.derive(df, key, "codes", build)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+def output_table(df, column):
+    """
+    Return the lookup table of an integer coded output column (see CustomDFAssigner.compact), or None
+    """
+    return df.attrs.get("codes", {}).get(column)
+
+def set_output_table(df, column, table):
+    """
+    Set (or drop, when table is None) the lookup table of an integer coded output column
+    """
+    tables = dict(df.attrs.get("codes", {}))
+    if table is None:
+        tables.pop(column, None)
+    else:
+        tables[column] = table
+    if tables:
+        df.attrs["codes"] = tables
+    else:
+        df.attrs.pop("codes", None)
+
+def decode_output(df, strings=False):
+    """
+    Return df with integer coded new_col/map_id (see CustomDFAssigner.compact) turned back into categoricals,
+    or with every compact output column turned into strings when strings is set. df itself isn't changed.
+    """
+    columns = {}
+    for column in ["new_col", "map_id"]:
+        if column not in df.columns:
+            continue
+        values = df[column]
+        table = output_table(df, column)
+        if table is not None:
+            values = pd.Series(pd.Categorical.from_codes(values.to_numpy(), table), index=df.index)
+        if strings and isinstance(values.dtype, pd.CategoricalDtype):
+            values = values.astype(str)
+        if values is not df[column]:
+            columns[column] = values
+    if not columns:
+        return df
+    decoded = df.assign(**columns)
+    for column in columns:
+        set_output_table(decoded, column, None)
+    return decoded
+
+def output_chunks(df, output, chunksize=100000):
+    """
+    Yield df joined with the new_col and map_id of output (see CustomDFAssigner.evaluate), chunksize rows at a time and
+    with the output columns as strings, so the joined frame is never built in full
+    """
+    for start in range(0, len(df), chunksize):
+        chunk = decode_output(output.iloc[start:start + chunksize], strings=True)
+        yield df.iloc[start:start + chunksize].assign(new_col=chunk["new_col"].to_numpy(), map_id=chunk["map_id"].to_numpy())
+
+def row_hashes(df, columns):
+    """
+    Return a uint64 hash of the values of the given columns for each row of df, the same for the same values in any run.
+    The distinct values of each column are hashed once (see pd.util.hash_pandas_object) and combined row by row.
+    """
+    hashes = np.zeros(len(df), dtype=np.uint64)
+    for column in columns:
+        codes, values = pd.factorize(df[column])
+        # missing values (code -1) take the 0 added at the end
+        value_hashes = np.r_[pd.util.hash_pandas_object(pd.Series(values), index=False).to_numpy(), np.uint64(0)]
+        hashes = hashes * np.uint64(1099511628211) ^ value_hashes[codes]
+    return hashes
+
+def assignment_state(df, hashes, plan):
+    """
+    Return what incremental_processing keeps of a run: the new_col and map_id of each row of df with its row hash,
+    indexed like df, with the digest of the map sets run in attrs["plan"]
+    """
+    output = decode_output(df[["new_col", "map_id"]], strings=True)
+    state = pd.DataFrame({"row_hash": hashes, "new_col": output["new_col"].to_numpy(), "map_id": output["map_id"].to_numpy()}, index=df.index)
+    state.attrs["plan"] = plan
+    return state
+
+def pack_mask(mask):
+    """
+    Pack a boolean array into a bitset of 64 bit words, returning the positions and values of its non-zero words
+    """
+    packed = np.packbits(mask, bitorder="little")
+    words = np.zeros((len(packed) + 7) // 8 * 8, dtype=np.uint8)
+    words[:len(packed)] = packed
+    words = words.view(np.uint64)
+    positions = np.flatnonzero(words)
+    return positions, words[positions]
+
+def pair_overlaps(owners, positions, words, max_block=10000000):
+    """
+    Given the non-zero words of several bitsets (the bitset each word belongs to, its position and its value, see pack_mask),
+    return arrays (i, j, count) with the number of bits set in both bitset i and bitset j, for every pair i < j sharing a bit.
+    Words are only compared with the words of other bitsets at the same position, and positions with the same number of
+    bitsets are compared together in blocks of at most max_block word pairs.
+    """
+    if len(owners) == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, empty
+    # bitsets numbered 0..size-1 so the counts fit a size x size matrix
+    bitsets, owners = np.unique(owners, return_inverse=True)
+    size = len(bitsets)
+    totals = np.zeros(size * size, dtype=np.int64)
+    # words grouped by position, bitsets in order within a position
+    order = np.lexsort((owners, positions))
+    owners, positions, words = owners[order], positions[order], words[order]
+    starts = np.flatnonzero(np.r_[True, positions[1:] != positions[:-1]])
+    sizes = np.diff(np.r_[starts, len(positions)])
+    for count in np.unique(sizes):
+        if count < 2:
+            continue
+        first, second = np.triu_indices(count, 1)
+        group = starts[sizes == count][:, None] + np.arange(0, count)
+        step = max(1, max_block // len(first))
+        for block in range(0, len(group), step):
+            rows = group[block:block + step]
+            block_words, block_owners = words[rows], owners[rows]
+            counts = np.bitwise_count(block_words[:, first] & block_words[:, second])
+            keys = (block_owners[:, first] * size + block_owners[:, second]).ravel()
+            totals += np.bincount(keys, weights=counts.ravel(), minlength=size * size).astype(np.int64)
+    pairs = np.flatnonzero(totals)
+    return bitsets[pairs // size], bitsets[pairs % size], totals[pairs]
+
+def mask_overlaps(owners, positions, words, sizes, flipped, rows):
+    """
+    Same as pair_overlaps for masks over rows rows, where the bitsets of the masks marked in flipped hold the rows the mask
+    doesn't match (sizes holds the number of bits set in each bitset). A mask matching most of the rows has fewer words
+    when flipped, so it costs much less to compare.
+    """
+    flipped = np.asarray(flipped, dtype=bool)
+    sizes = np.asarray(sizes, dtype=np.int64)
+    first, second, counts = pair_overlaps(owners, positions, words)
+    keep = ~(flipped[first] | flipped[second])
+    shared = dict(((i, j), count) for i, j, count in zip(first[~keep], second[~keep], counts[~keep]))
+    first, second, counts = [first[keep]], [second[keep]], [counts[keep]]
+    # a pair with a flipped mask can overlap without its bitsets sharing a bit, so all of those pairs are worked out
+    plain, flips = np.flatnonzero(~flipped), np.flatnonzero(flipped)
+    for i in flips:
+        others = np.r_[plain, flips[flips > i]]
+        low, high = np.minimum(i, others), np.maximum(i, others)
+        common = np.array([shared.get(pair, 0) for pair in zip(low, high)], dtype=np.int64)
+        overlap = np.where(flipped[others], rows - sizes[i] - sizes[others] + common, sizes[others] - common)
+        found = overlap > 0
+        first.append(low[found])
+        second.append(high[found])
+        counts.append(overlap[found])
+    first, second, counts = np.concatenate(first), np.concatenate(second), np.concatenate(counts)
+    order = np.lexsort((second, first))
+    return first[order], second[order], counts[order]
+
+class ChunkWriter(object):
+    """
+    Appends DataFrame chunks to a csv file, or to a parquet file when the path ends in .parquet (needs pyarrow).
+    In a parquet file, string_columns are always strings, whatever type they have in the first chunk (e.g. all missing).
+    """
+    def __init__(self, path, string_columns=()):
+        self.path = path
+        self.parquet = path.lower().endswith(".parquet")
+        self.string_columns = set(string_columns) | set(["new_col", "map_id"])
+        self.writer = None
+        self.file = None
+
+    def write(self, df):
+        # compact output columns are only turned into strings here, a chunk at a time
+        df = decode_output(df, strings=True)
+        if self.parquet:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            if self.writer is None:
+                schema = pa.Schema.from_pandas(df, preserve_index=False)
+                schema = pa.schema([field.with_type(pa.large_string()) if field.name in self.string_columns else field for field in schema], metadata=schema.metadata)
+                table = pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+                self.writer = pq.ParquetWriter(self.path, table.schema)
+            else:
+                # later chunks are cast to the schema of the first one
+                table = pa.Table.from_pandas(df, schema=self.writer.schema, preserve_index=False)
+            self.writer.write_table(table)
+        else:
+            if self.file is None:
+                self.file = open(self.path, "w", newline="")
+                df.to_csv(self.file, index=False)
+            else:
+                df.to_csv(self.file, index=False, header=False)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        if self.file is not None:
+            self.file.close()
+
+class RunProfile(object):
+    """
+    Timings and row counts of assignment runs, per map id and per post_run level.
+    Set it as the profile of a CustomDFAssigner and every run of a map set over a df adds one entry to runs.
+    """
+    def __init__(self):
+        self.runs = []
+
+    def start_run(self, env, rows):
+        run = {"env": env, "rows": rows, "seconds": 0.0, "evaluations": 0, "evaluations_saved": 0, "levels": [], "maps": {}, "invalid_maps": []}
+        self.runs.append(run)
+        return run
+
+    def merge(self, runs):
+        """
+        Add the runs of the partitions of one df as a single run, summing their counts and timings.
+        Levels are matched by name, as a partition stops at the level that assigns its last rows.
+        """
+        merged = copy_run(runs[0])
+        levels = dict((level["level"], level) for level in merged["levels"])
+        for run in runs[1:]:
+            add_counts(merged, run)
+            for level in run["levels"]:
+                if level["level"] in levels:
+                    add_counts(levels[level["level"]], level)
+                else:
+                    levels[level["level"]] = dict(level)
+                    merged["levels"].append(levels[level["level"]])
+            for map_id, stats in run["maps"].items():
+                if map_id in merged["maps"]:
+                    add_counts(merged["maps"][map_id], stats)
+                else:
+                    merged["maps"][map_id] = dict(stats)
+        self.runs.append(merged)
+        return merged
+
+    def report(self):
+        """
+        Return the runs as a json serializable dict, with the totals over all of them
+        """
+        return {
+            "seconds": sum(run["seconds"] for run in self.runs),
+            "evaluations": sum(run["evaluations"] for run in self.runs),
+            "evaluations_saved": sum(run["evaluations_saved"] for run in self.runs),
+            "runs": self.runs,
+        }
+
+def copy_run(run):
+    return dict(run, levels=[dict(level) for level in run["levels"]], maps=dict((map_id, dict(stats)) for map_id, stats in run["maps"].items()))
+
+def add_counts(total, counts):
+    """
+    Add the numbers in counts to the same fields of total
+    """
+    for field, value in counts.items():
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            total[field] += value
+
+# state of a parallel_assignment_processor worker process, set once by _init_worker
+_worker = {}
+
+def _init_worker(env, levels, map_set, profile=False):
+    _worker["assigner"] = CustomDFAssigner(env)
+    _worker["assigner"].levels = levels
+    _worker["map_set"] = map_set
+    _worker["profile"] = profile
+
+def _process_partition(partition):
+    """
+    Run the worker's map set over one partition and return its new_col and map_id values (and its run profile, if profiling)
+    """
+    assigner = _worker["assigner"]
+    if _worker["profile"]:
+        assigner.profile = RunProfile()
+    partition = assigner.custom_assignment_processor(partition, _worker["map_set"])
+    if partition is None:
+        return None
+    run = assigner.profile.runs[0] if _worker["profile"] else None
+    return partition["new_col"].to_numpy(), partition["map_id"].to_numpy(), run
+
+def load_map_set(path):
+    """
+    Return the compiled map set for a map file, only rebuilding it when the file has changed
+    """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    map_set = _MAP_SET_CACHE.get(path)
+    if map_set is not None and map_set.mtime == stat.st_mtime_ns and map_set.size == stat.st_size:
+        return map_set
+    with open(path, "rb") as f:
+        content = f.read()
+    digest = hashlib.sha256(content).hexdigest()
+    if map_set is not None and map_set.digest == digest:
+        map_set.mtime, map_set.size = stat.st_mtime_ns, stat.st_size
+        return map_set
+    map_set = CompiledMapSet(json.loads(content), path=path, digest=digest, mtime=stat.st_mtime_ns, size=stat.st_size)
+    _MAP_SET_CACHE[path] = map_set
+    return map_set
+
+class MapRegistry(object):
+    """
+    Index of the map files in a map directory by lowercased env name, so envs and map ids are found without scanning the directory.
+    The directory is only listed again when its mtime changes (a file was added, removed or renamed),
+    and map sets come from load_map_set, so a file is only read again when its mtime or size changes.
+    Use MapRegistry.get to share one registry per directory.
+    """
+    registries = {}
+
+    def __init__(self, location):
+        self.location = location
+        self.mtime = None
+        self.files = {}
+
+    @classmethod
+    def get(cls, location):
+        key = os.path.abspath(location)
+        if key not in cls.registries:
+            cls.registries[key] = cls(location)
+        return cls.registries[key]
+
+    def refresh(self, force=False):
+        """
+        List the directory again if it has changed since it was indexed
+        """
+        mtime = os.stat(self.location).st_mtime_ns
+        if mtime == self.mtime and not force:
+            return
+        files = {}
+        for fn in sorted(os.listdir(self.location)):
+            env, extension = os.path.splitext(fn)
+            if extension.lower() == ".json" and os.path.isfile(os.path.join(self.location, fn)):
+                files.setdefault(env.lower(), []).append(fn)
+        self.files = files
+        self.mtime = mtime
+
+    def path(self, env):
+        """
+        Return the path of the map file for env (matched case insensitively, an exact match first), or None
+        """
+        self.refresh()
+        names = self.files.get(env.lower())
+        if not names:
+            # a file added within the mtime resolution of the last listing wouldn't have changed the directory's mtime
+            self.refresh(force=True)
+            names = self.files.get(env.lower())
+        if not names:
+            return None
+        fn = env + ".json" if env + ".json" in names else names[0]
+        return os.path.join(self.location, fn)
+
+    def map_set(self, env):
+        """
+        Return the compiled map set of env, or None when there's no map file for it
+        """
+        path = self.path(env)
+        return None if path is None else load_map_set(path)
+
+    def lookup(self, map_id, found=None):
+        """
+        Return a copy of the map with the given id ({env}_{index}, the env matched case insensitively).
+        found caches map sets by env across several lookups, so each file is only checked once.
+        """
+        env, index = map_id.rsplit("_", 1)
+        if found is None:
+            found = {}
+        if env.lower() not in found:
+            found[env.lower()] = self.map_set(env)
+        map_set = found[env.lower()]
+        if map_set is None:
+            raise Exception(f"+--ERROR: Map set not found at this path:\n{os.path.join(self.location, env)}.json--+")
+        index = int(index)
+        if index >= 0 and index < len(map_set):
+            return deepcopy(map_set.raw[index])
+        else:
+            raise Exception("+-- Error: Map ID not found --+")
 
 class CustomDFAssigner(object):
     def __init__(self,env,maps_loc=PATH_TO_MAPS):
         self.env = env #also the name of the json to use
         self.map_location = maps_loc if maps_loc[-1] == '/' else maps_loc+'/'
         self.levels = ["L1", "L2"] #order to run certain maps within env file
+        self.column_cache = ColumnCache() #lowercased key columns, shared by every map in a run
+        self.multi_pattern = True #find contains values with the map set's matchers instead of one pass per value
+        self.categorical = False #evaluate every key column on its distinct values (categorical columns always are)
+        self.map_set = None #map set of the current run
+        self.registry = MapRegistry.get(self.map_location) #map files of map_location
+        self.profile = None #RunProfile to record runs in, only when profiling
+        self.evaluations = 0 #predicate evaluations so far
+        self.evaluations_saved = 0 #predicate evaluations skipped by reusing the mask of a predicate shared by several maps
+        self.predicate_uses = {} #uses left in the current run of each shared predicate
+        self.compact = None #"category" or "codes" to keep new_col and map_id as categoricals or int32 codes (see decode_output)
+        self.progress = None #called with (maps done, maps to run) as a run goes on
+        self.maps_done = 0 #maps run so far in the current run
+        self.maps_total = 0 #maps to run in the current run
+        self.rows_evaluated = 0 #rows the maps ran on in the last incremental_processing
 
-    def start_processing(self,df, additional_check=False):
+    def start_processing(self,df, additional_check=False, workers=1, partition_size=100000, dedupe=False, profile=False):
         """
         This method loads the correct mapping and then calls the method to run the found maps on the df
+        (split over worker processes when workers is not 1, see parallel_assignment_processor).
+        With dedupe the maps only run on the distinct combinations of the columns they read,
+        and the results are copied back to every row with that combination.
+        With profile, returns (df, report) where report holds the timings and row counts of each map (see RunProfile).
         """
         try:
-            # finds the correct map file of jsons to use
-            path = self.map_location + self.env + ".json"
-            if os.path.exists(path):
-                json_map_set = path
+            if profile:
+                self.profile = RunProfile()
+            if workers == 1:
+                processor = self.custom_assignment_processor
             else:
-                map_found = False
-                for fn in os.listdir(self.map_location):
-                    if os.path.isfile(os.path.join(self.map_location, fn)):
-                        if self.env.lower() == fn.split(".")[0].lower():
-                            json_map_set = self.map_location + fn
-                            map_found = True 
-                            break 
-                if not map_found:
-                    raise Exception(f"+--ERROR: Map set not found at this path:\n{path}--+")
-
-            maps_found_list = json.loads(open(json_map_set,"r").read())
+                processor = lambda df, map_set: self.parallel_assignment_processor(df, map_set, workers, partition_size)
+            map_sets = self.load_map_sets(additional_check)
+            target = df
+            if dedupe:
+                columns = [col for col in df.columns if col in ["new_col", "map_id"] or any(col in map_set.columns for env, map_set in map_sets)]
+                if columns:
+                    target, groups = self.dedupe_rows(df, columns)
             # runs the maps over the given data frame
-            df = self.custom_assignment_processor(
-                df,
-                maps_found_list
-            )
-            if additional_check == True:
-                extra_file = "extra"
-                path = self.map_location + extra_file + ".json"
-                if os.path.exists(path):
-                    json_map_set = path
-                else:
-                    raise Exception(f"+--ERROR: Could not run additional_check - {extra_file}.json not found:\n{path}--+")
-                self.env=extra_file
-                df = self.custom_assignment_processor(
-                    df, 
-                    json.loads(open(json_map_set,"r").read()))
+            for env, map_set in map_sets:
+                self.env = env
+                target = processor(
+                    target,
+                    map_set
+                )
+            if target is None:
+                return None
+            if target is not df:
+                for column in ["new_col", "map_id"]:
+                    values = target[column]
+                    if isinstance(values.dtype, pd.CategoricalDtype):
+                        df[column] = pd.Categorical.from_codes(values.cat.codes.to_numpy()[groups], dtype=values.dtype)
+                    else:
+                        df[column] = values.to_numpy()[groups]
+                    set_output_table(df, column, output_table(target, column))
+            if profile:
+                return df, self.profile.report()
             # returns the df with column corresponding escalation group (or unknown)
             return df
-        except Exception as e:
-            if "+--ERROR: Could not run additional_check" in str(e):
-                return df
-            else: 
-                traceback.print_exc()
+        except:
+            traceback.print_exc()
+        finally:
+            if profile:
+                self.profile = None
+
+    def load_map_sets(self, additional_check=False):
+        """
+        Return the (env, map set) pairs start_processing runs, in order
+        """
+        # compiled once per file and reused until the file changes
+        map_sets = [(self.env, load_map_set(self.find_map_set()))]
+        if additional_check == True:
+            extra_file = "extra"
+            extra_set = self.registry.map_set(extra_file)
+            # without an extra.json only the env's maps are run
+            if extra_set is not None:
+                map_sets.append((extra_file, extra_set))
+        return map_sets
+
+    def incremental_processing(self, df, previous=None, additional_check=False, state_path=None, profile=False, **kwargs):
+        """
+        Same as start_processing (kwargs are passed on to it), reusing the new_col and map_id of the rows that haven't changed
+        since a previous run, so the maps only run on new and changed rows. Rows are matched to the previous run by index,
+        and a row has changed when the hash of the columns the maps read has (see row_hashes).
+        previous is the df returned by an earlier incremental_processing, or the path of a state file it saved;
+        with state_path the state of this run is saved there, and read from there when previous isn't given.
+        Every row is run again when the map files (or their columns) have changed since the previous run.
+        Any new_col and map_id already in df are replaced.
+        With profile, returns (df, report) where report only covers the rows that were run (see start_processing).
+        """
+        try:
+            map_sets = self.load_map_sets(additional_check)
+            columns = sorted(set(col for env, map_set in map_sets for col in map_set.columns if col in df.columns))
+            plan = hashlib.sha256(json.dumps([[env, map_set.digest] for env, map_set in map_sets] + [self.levels, columns]).encode("utf-8")).hexdigest()
+            hashes = row_hashes(df, columns)
+            if previous is None and state_path is not None and os.path.exists(state_path):
+                previous = state_path
+            if isinstance(previous, str):
+                previous = pd.read_pickle(previous)
+            elif previous is not None and all(col in previous.columns for col in columns):
+                previous = assignment_state(previous, row_hashes(previous, columns), previous.attrs.get("plan"))
+            else:
+                # a previous df without the columns the maps read can't be compared
+                previous = None
+
+            source = df[[col for col in df.columns if col not in ["new_col", "map_id"]]]
+            if previous is None or previous.attrs.get("plan") != plan or not (df.index.is_unique and previous.index.is_unique):
+                changed = np.ones(len(df), dtype=bool)
+            else:
+                # position of each row in the previous run, -1 for new rows
+                found = previous.index.get_indexer(df.index)
+                changed = (found < 0) | (previous["row_hash"].to_numpy()[found] != hashes)
+            self.rows_evaluated = int(changed.sum())
+            updated = None
+            report = RunProfile().report()
+            if changed.any():
+                updated = self.start_processing(source[changed], additional_check, profile=profile, **kwargs)
+                if updated is None:
+                    return None
+                if profile:
+                    updated, report = updated
+                updated = decode_output(updated, strings=True)
+
+            # unchanged rows take their value from the previous run and the others the new one, as codes into one table
+            for column in ["new_col", "map_id"]:
+                codes = np.zeros(len(df), dtype=np.int32)
+                position = {}
+                if not changed.all():
+                    previous_codes, previous_table = pd.factorize(previous[column])
+                    codes[~changed] = previous_codes[found[~changed]]
+                    position = dict((label, index) for index, label in enumerate(previous_table))
+                if updated is not None:
+                    new_codes, new_table = pd.factorize(updated[column])
+                    codes[changed] = np.array([position.setdefault(label, len(position)) for label in new_table], dtype=np.int32)[new_codes]
+                df[column] = codes
+                set_output_table(df, column, list(position))
+            # then put in the format set by self.compact
+            if self.compact != "codes":
+                output = decode_output(df[["new_col", "map_id"]], strings=self.compact is None)
+                for column in ["new_col", "map_id"]:
+                    df[column] = output[column]
+                    set_output_table(df, column, None)
+            df.attrs["plan"] = plan
+            if state_path is not None:
+                assignment_state(df, hashes, plan).to_pickle(state_path)
+            if profile:
+                return df, report
+            return df
+        except:
+            traceback.print_exc()
+
+    def dedupe_rows(self, df, columns):
+        """
+        Return a df of the distinct combinations of the given columns, and for each row of df the position of its combination
+        """
+        groups = df.groupby(columns, sort=False, dropna=False).ngroup().to_numpy()
+        first = np.unique(groups, return_index=True)[1]
+        return df.iloc[first][columns].reset_index(drop=True), groups
+
+    def find_map_set(self):
+        """
+        Return the path of the map file for self.env (the file name match is case insensitive)
+        """
+        path = self.registry.path(self.env)
+        if path is None:
+            raise Exception(f"+--ERROR: Map set not found at this path:\n{self.map_location + self.env}.json--+")
+        return path
+
+    def stream_csv(self, input_path, output_path, chunksize=100000, additional_check=False, **read_options):
+        """
+        Run the maps over a csv too large for memory, reading and processing it chunksize rows at a time.
+        Each processed chunk (with new_col and map_id) is appended to output_path, a .csv or .parquet file.
+        The columns the maps read are read as strings (unless read_options has a dtype for them), so they have the same type
+        in every chunk, even in a chunk where they are all missing.
+        Returns the number of rows written.
+        """
+        try:
+            env = self.env
+            map_set = load_map_set(self.find_map_set())
+            extra_set = None
+            if additional_check == True:
+                extra_set = self.registry.map_set("extra")
+            columns = set(map_set.columns) | set(extra_set.columns if extra_set is not None else [])
+            read_options = dict(read_options)
+            if read_options.get("dtype") is None or isinstance(read_options["dtype"], dict):
+                read_options["dtype"] = dict(dict((col, str) for col in columns), **(read_options.get("dtype") or {}))
+            writer = None
+            rows = 0
+            try:
+                for chunk in pd.read_csv(input_path, chunksize=chunksize, **read_options):
+                    self.env = env
+                    chunk = self.custom_assignment_processor(chunk, map_set)
+                    if chunk is not None and extra_set is not None:
+                        self.env = "extra"
+                        chunk = self.custom_assignment_processor(chunk, extra_set)
+                    if chunk is None:
+                        raise Exception(f"+--ERROR: Could not process rows {rows} to {rows + chunksize} of {input_path}--+")
+                    if writer is None:
+                        writer = ChunkWriter(output_path, columns)
+                    writer.write(chunk)
+                    rows += len(chunk)
+            finally:
+                self.env = env
+                if writer is not None:
+                    writer.close()
+            return rows
+        except:
+            traceback.print_exc()
 
     def logic_parser(self, df, logic, key, value):
         """
         For a given df, run the given logic to return a filtered df
         """
         try:
-            #If value is a list of values, then run those values with the assigned logic, returning all values combined using "or logic"
-            if isinstance(value, list):
-                running_df = pd.DataFrame()
-                for item in value:
-                    temp_df = self.logic_parser(df, logic, key, item)
-                    running_df = pd.concat([running_df, temp_df])
-                return running_df.drop_duplicates()
-            
-            if logic == "equals":
-                return df[df[key].str.lower() == value]
-            elif logic == "not_equals":
-                return df[df[key].str.lower() != value]
-            elif logic == "contains":
-                return df[df[key].str.lower().str.contains(value, na=False, regex=False)]
-            elif logic == "not_contains":
-                return df[df[key].str.lower().str.contains(value, na=False, regex=False) == False]
-            elif logic == "starts_with":
-                return df[df[key].str.lower().str.startswith(value)]
-            else:
-                raise Exception(f"+--ERROR: {logic} is not a valid option.--+")
+            return df[self.predicate_mask(df, logic, key, value)]
         except:
             traceback.print_exc()
 
+    def predicate_mask(self, df, logic, key, value, rows=None):
+        """
+        For a given df, run the given logic to return a boolean array of the matching rows
+        (only for the rows at the given positions, when rows is given)
+        """
+        #If value is a list of values, then run those values with the assigned logic, combining them using "or logic"
+        if isinstance(value, list):
+            mask = np.zeros(len(df) if rows is None else len(rows), dtype=bool)
+            for item in value:
+                mask |= self.predicate_mask(df, logic, key, item, rows)
+            return mask
+        self.evaluations += 1
+
+        # an index is only built for a full pass, a few rows are cheaper to check directly
+        if self.indexed(df, logic, key, value) and (rows is None or self.column_cache.has(key, "prefix" if logic == "starts_with" else "contains")):
+            if logic == "starts_with":
+                codes, index = self.column_cache.derive(df, key, "prefix", lambda: self.prefix_index(df, key))
+                return index.mask(value)[codes if rows is None else codes[rows]]
+            codes, found = self.column_cache.derive(df, key, "contains", lambda: self.pattern_matches(df, key, self.map_set.matchers[key]))
+            mask = found[value][codes if rows is None else codes[rows]]
+            return mask if logic == "contains" else ~mask
+
+        if self.use_codes(df, key):
+            # run the logic on the distinct values, then look each row's result up by its code
+            codes, values = self.column_cache.coded(df, key)
+            return self.string_matches(values, logic, value)[codes if rows is None else codes[rows]]
+        column = self.column_cache.lower(df, key)
+        return self.string_matches(column if rows is None else column.iloc[rows], logic, value)
+
+    def indexed(self, df, logic, key, value):
+        """
+        Whether a contains/not_contains value is found with the map set's matcher for key,
+        or a starts_with value with the prefix index of key
+        """
+        if self.map_set is None or df is not self.column_cache.df:
+            return False
+        if logic in ["contains", "not_contains"] and self.multi_pattern:
+            matcher = self.map_set.matchers.get(key)
+            return matcher is not None and value in matcher.index and self.use_matcher(df, key, matcher)
+        return logic == "starts_with" and key in self.map_set.prefix_keys
+
+    def use_matcher(self, df, key, matcher):
+        """
+        Whether the matcher's single scan of each distinct value of df[key] is cheaper than checking the rows once per
+        contains value. Both costs grow with the mean value length, so this compares patterns x rows checked
+        against MATCHER_COST x distinct values. Worked out once per key for the bound df.
+        """
+        def build():
+            stats = self.column_cache.derive(df, key, "stats", lambda: self.column_stats(df, key))
+            # the per value path checks only the distinct values of coded columns too
+            checked = stats["distinct"] if self.use_codes(df, key) else stats["rows"]
+            return len(matcher.index) * checked >= MATCHER_COST * stats["distinct"]
+        return self.column_cache.derive(df, key, "matcher", build)
+
+    def use_codes(self, df, key):
+        """
+        Whether df[key] is evaluated on its distinct values instead of row by row
+        """
+        return df is self.column_cache.df and (self.categorical or isinstance(df[key].dtype, pd.CategoricalDtype))
+
+    def string_matches(self, column, logic, value):
+        """
+        Run the given logic on a lowercased column and return a boolean array
+        """
+        if logic == "equals":
+            matches = column == value
+        elif logic == "not_equals":
+            matches = column != value
+        elif logic == "contains":
+            matches = column.str.contains(value, na=False, regex=False)
+        elif logic == "not_contains":
+            matches = column.str.contains(value, na=False, regex=False) == False
+        elif logic == "starts_with":
+            matches = column.str.startswith(value)
+        else:
+            raise Exception(f"+--ERROR: {logic} is not a valid option.--+")
+        return matches.to_numpy(dtype=bool, na_value=False)
+
+    def pattern_matches(self, df, key, matcher):
+        """
+        Scan each distinct value of df[key] once for all of the matcher's patterns.
+        Returns the row codes (see ColumnCache.coded) and {pattern: boolean array over the distinct values}.
+        """
+        codes, values = self.column_cache.coded(df, key)
+        return codes, matcher.masks(list(values))
+
+    def prefix_index(self, df, key):
+        """
+        Build a prefix index over the distinct values of df[key].
+        Returns the row codes (see ColumnCache.coded) and the index.
+        """
+        codes, values = self.column_cache.coded(df, key)
+        return codes, PrefixIndex(list(values))
+
     def run_map_config(self,df,map_config,associated_query):
         """
-        Recursively filter the df and return df of rows that match all map queries
+        Return df of the unassigned rows that match all map queries
         """
         try:
-            map_config["logic"] = map_config["logic"].lower().strip()
-            if isinstance(map_config["value"], list):
-                map_config["value"] = list(map(str.strip, map(str.lower, map_config["value"])))
-            else:
-                map_config["value"] = map_config["value"].lower().strip()
-
-            logic = map_config["logic"]
-            key = map_config["key"]
-            value = map_config["value"]
-
-            if len(associated_query) == 0:
-                #return self.logic_parser(df, logic, key, value) #This row will overwrite previously assigned rows
-                return self.logic_parser(df[df["new_col"] == 'unknown'], logic, key, value)
-            
-            #pop automatically removes the element from the list
-            next_map_config = associated_query.pop(0)
-            
-            df_filtered = self.run_map_config(df, next_map_config, associated_query)
-            return self.logic_parser(df_filtered, logic, key, value)
+            mask = self.query_mask(
+                df,
+                normalize_query(map_config),
+                [normalize_query(child) for child in associated_query])
+            #only unassigned rows, otherwise previously assigned rows would be overwritten
+            return df[mask & self.unknown_rows(df)]
         except:
             traceback.print_exc()
 
+    def query_mask(self,df,map_config,associated_query,rows=None):
+        """
+        Return a boolean array of the rows that match a normalized map and all of its associated queries (see CompiledMapSet),
+        out of the given rows (a boolean array) if any.
+        The predicates run in the order of query_rank, each only on the rows that matched the ones before it
+        once those are few enough to be worth picking out.
+        """
+        mask = rows
+        for query in self.order_queries(df, [map_config] + list(associated_query)):
+            positions = None if mask is None else np.flatnonzero(mask)
+            if positions is not None and len(positions) == 0:
+                break
+            # shared predicates are evaluated over every row once and reused, see shared_mask
+            if positions is None or 2 * len(positions) > len(df) or self.shared(df, predicate_key(query)):
+                matches = self.shared_mask(df, query)
+                mask = matches if mask is None else mask & matches
+            else:
+                mask = np.zeros(len(df), dtype=bool)
+                mask[positions[self.predicate_mask(df, query["logic"], query["key"], query["value"], positions)]] = True
+        return mask
+
+    def order_queries(self, df, queries):
+        """
+        Sort the predicates of a map by query_rank, keeping file order for ties
+        """
+        # on frames no bigger than the sample, working out the order costs about as much as any order would
+        if len(queries) < 2 or df is not self.column_cache.df or len(df) <= SAMPLE_ROWS:
+            return queries
+        return sorted(queries, key=lambda query: self.query_rank(df, query))
+
+    def query_rank(self, df, query):
+        """
+        Return the estimated cost per row of a predicate divided by the share of rows it filters out, so that
+        predicates that are cheap and selective rank first. Worked out once per predicate for the bound df.
+        """
+        predicate = predicate_key(query)
+        logic, key, value = query["logic"], query["key"], query["value"]
+        def build():
+            stats = self.column_cache.derive(df, key, "stats", lambda: self.column_stats(df, key))
+            items = value if isinstance(value, list) else [value]
+            if self.shared(df, predicate):
+                # evaluated once for every map that uses it
+                cost = 0.1
+            elif all(self.indexed(df, logic, key, item) for item in items) or self.use_codes(df, key):
+                cost = 0.1 * len(items)
+            elif logic in ["equals", "not_equals"]:
+                cost = len(items)
+            else:
+                cost = (1 + stats["length"] / 16) * len(items)
+            # sampling isn't part of the evaluations of the run
+            evaluations = self.evaluations
+            selectivity = self.predicate_mask(df, logic, key, value, stats["sample"]).mean() if len(stats["sample"]) else 0
+            self.evaluations = evaluations
+            return cost / max(1 - selectivity, 0.001)
+        return self.column_cache.derive(df, key, ("rank",) + predicate, build)
+
+    def column_stats(self, df, key):
+        """
+        Return the row count, distinct count, mean string length and a sample of row positions of df[key]
+        """
+        sample = np.random.default_rng(0).choice(len(df), size=min(len(df), SAMPLE_ROWS), replace=False)
+        sample.sort()
+        lengths = df[key].iloc[sample].str.len()
+        return {
+            "rows": len(df),
+            "distinct": df[key].nunique(dropna=False),
+            "length": float(lengths.mean()) if lengths.notna().any() else 0.0,
+            "sample": sample,
+        }
+
+    def shared(self, df, predicate):
+        """
+        Whether a predicate is used by several maps of the map set being run over df
+        """
+        return self.map_set is not None and self.map_set.predicates.get(predicate, 0) > 1 and df is self.column_cache.df
+
+    def shared_mask(self, df, query):
+        """
+        Return the predicate mask of a normalized map or associated query. Predicates used by several maps of the map set
+        are only evaluated once per run (until their column changes), see CompiledMapSet.predicates
+        """
+        predicate = predicate_key(query)
+        if not self.shared(df, predicate):
+            return self.predicate_mask(df, query["logic"], query["key"], query["value"])
+        built = []
+        def build():
+            evaluations = self.evaluations
+            mask = self.predicate_mask(df, query["logic"], query["key"], query["value"])
+            built.append(True)
+            return mask, self.evaluations - evaluations
+        mask, evaluations = self.column_cache.derive(df, query["key"], ("predicate",) + predicate, build)
+        if not built:
+            self.evaluations_saved += evaluations
+        # the mask is dropped after its last use, so only the masks of predicates still to come are held
+        self.predicate_uses[predicate] = self.predicate_uses.get(predicate, self.map_set.predicates[predicate]) - 1
+        if self.predicate_uses[predicate] == 0:
+            self.column_cache.discard(query["key"], ("predicate",) + predicate)
+        return mask
+
     def custom_assignment_processor(self,df,maps_found_list):
         """
         Run each map over the df and update the new_col for the found rows
@@ -120,51 +1174,37 @@ class CustomDFAssigner(object):
             # if df is not empty
             if len(df):
                 # add column to df with default value
-                if "new_col" not in list(df.columns):
-                    df["new_col"] = "unknown"
+                self.prepare_output(df)
+                self.column_cache.bind(df)
+                self.predicate_uses = {}
                 
-                if "map_id" not in list(df.columns):
-                    df["map_id"] = "unknown"
-                
-                catches = []
-                levels = copy(self.levels)
-                while True:
-                    map_list = []
-                    for map_json_elem in maps_found_list:
-                        if "associated_query" not in list(map_json_elem.keys()):
-                            map_json_elem["associated_query"] = []
-                        target = []
-                        target.append(map_json_elem)
-                        if self.map_validator(df, target) is None:
-                            catches.append(map_json_elem)
-                        elif "post_run" in list(map_json_elem.keys()):
-                            if map_json_elem["post_run"] in levels:
-                                map_list.append(map_json_elem)
-                            else:
-                                df_filtered = self.run_map_config(
-                                    df,
-                                    map_config = map_json_elem,
-                                    associated_query = map_json_elem["associated_query"])
-                                # use filtered df to get row indicies and then use those to update the correct rows
-                                if len(df_filtered):
-                                    indicies = df_filtered.index
-                                    df.loc[indicies,["new_col", "map_id"]] = [map_json_elem["assign_to"], f"{self.env}_{maps_found_list.index(map_json_elem)}"]
-                        else:
-                            df_filtered = self.run_map_config(
-                                df,
-                                map_config = map_json_elem,
-                                associated_query = map_json_elem["associated_query"])
-                            # use filtered df to get row indicies and then use those to update the correct rows
-                            if len(df_filtered):
-                                indicies = df_filtered.index
-                                df.loc[indicies,["new_col", "map_id"]] = [map_json_elem["assign_to"], f"{self.env}_{maps_found_list.index(map_json_elem)}"]
-
-                    if map_list:
-                        maps_found_list = map_list
-                        levels.pop(0)
-                    else:
+                # lists of maps (e.g. from the API) are compiled here, map files come precompiled from load_map_set
+                if isinstance(maps_found_list, CompiledMapSet):
+                    map_set = maps_found_list
+                else:
+                    map_set = CompiledMapSet(maps_found_list)
+                map_ids = map_set.map_ids(self.env)
+                self.map_set = map_set
+                catches = map_set.invalid_maps(list(df.columns), self.levels)
+                if self.profile is not None:
+                    run = self.profile.start_run(self.env, len(df))
+                    run["invalid_maps"] = list(map_ids[catches])
+                    started = time.perf_counter()
+                # rows that can still be assigned, updated as maps assign rows
+                unknown = self.unknown_rows(df)
+                schedule = map_set.schedule(list(df.columns), self.levels)
+                self.maps_done, self.maps_total = 0, sum(len(indices) for _, indices in schedule)
+                self.report_progress(0)
+                for level, indices in schedule:
+                    # later levels can only assign rows that are still unknown
+                    if not unknown.any():
                         break
-                assert catches == [], f"The following maps were not used for being invalid: {catches}"                        
+                    unknown = self.assign_level(df, map_set, indices, map_ids, unknown, level or "default")
+                # maps of levels skipped once every row was assigned are done too
+                self.report_progress(self.maps_total - self.maps_done)
+                if self.profile is not None:
+                    run["seconds"] = time.perf_counter() - started
+                assert catches == [], f"The following maps were not used for being invalid: {[map_set.raw[index] for index in catches]}"                        
             else:
                 raise Exception(f"+--ERROR: Custom_assignment_processor - Recieved Empty DF - {self.env}--+")
             return df
@@ -173,100 +1213,398 @@ class CustomDFAssigner(object):
                 return df
             else:
                 traceback.print_exc()
+        finally:
+            self.column_cache.release()
+            self.map_set = None
     
+    def assign_level(self, df, map_set, indices, map_ids, unknown, level=None):
+        """
+        Run one level of maps over the unassigned rows, where the first map (in file order) that matches a row wins it.
+        Returns the rows that are still unassigned afterwards.
+        """
+        singles, groups = map_set.dispatch(indices)
+        no_map = len(map_set)
+        # index of the winning map for each row, no_map where nothing matched
+        winner = np.full(len(df), no_map)
+        # maps assigning 'unknown' leave the row open, so they only keep the row when no other map matches it
+        fallback = np.full(len(df), -1)
+        profiling = self.profile is not None
+        if profiling:
+            started, evaluations, saved, timings, matches = time.perf_counter(), self.evaluations, self.evaluations_saved, {}, {}
+        for (logic, key), group in groups.items():
+            if profiling:
+                group_started = time.perf_counter()
+                # a group is looked up once for all of its maps
+                self.evaluations += 1
+            if logic == "equals" and self.use_codes(df, key):
+                codes, values = self.column_cache.coded(df, key)
+                found = values.map(group).fillna(no_map).to_numpy(dtype=np.int64)[codes]
+            elif logic == "equals":
+                found = self.column_cache.lower(df, key).map(group).fillna(no_map).to_numpy(dtype=np.int64)
+            else:
+                codes, index = self.column_cache.derive(df, key, "prefix", lambda: self.prefix_index(df, key))
+                found = index.first_match(group, no_map)[codes]
+            winner = np.minimum(winner, np.where(unknown, found, no_map))
+            if profiling:
+                members = [index for index in indices if index not in singles and (map_set.maps[index]["logic"], map_set.maps[index]["key"]) == (logic, key)]
+                for index in members:
+                    timings[index] = ((time.perf_counter() - group_started) / len(members), 0, 0)
+        self.report_progress(len(indices) - len(singles))
+        for index in singles:
+            map_json_elem = map_set.maps[index]
+            if profiling:
+                map_started, map_evaluations, map_saved = time.perf_counter(), self.evaluations, self.evaluations_saved
+            mask = self.query_mask(
+                df,
+                map_config = map_json_elem,
+                associated_query = map_json_elem["associated_query"],
+                rows = unknown)
+            if profiling:
+                timings[index] = (time.perf_counter() - map_started, self.evaluations - map_evaluations, self.evaluations_saved - map_saved)
+                # positions only, so the profile holds the rows each map matched rather than a mask per map
+                matches[index] = np.flatnonzero(mask & unknown)
+            if map_json_elem["assign_to"] == 'unknown':
+                fallback[mask] = index
+            else:
+                winner[mask & (winner > index)] = index
+            self.report_progress(1)
+
+        assigned = winner < no_map
+        fallback[assigned] = -1
+        kept = fallback >= 0
+        # use the masks of won rows to update the correct rows
+        if assigned.any():
+            self.write_output(df, "new_col", assigned, map_set.assign_to, winner[assigned])
+            self.write_output(df, "map_id", assigned, map_ids, winner[assigned])
+        if kept.any():
+            self.write_output(df, "new_col", kept, map_set.assign_to, fallback[kept])
+            self.write_output(df, "map_id", kept, map_ids, fallback[kept])
+        self.column_cache.invalidate(["new_col", "map_id"])
+        if profiling:
+            self.profile.runs[-1]["levels"].append({
+                "level": level,
+                "map_ids": list(map_ids[indices]),
+                "seconds": time.perf_counter() - started,
+                "evaluations": self.evaluations - evaluations,
+                "evaluations_saved": self.evaluations_saved - saved,
+                "rows_in": int(unknown.sum()),
+                "rows_assigned": int(assigned.sum()),
+                "rows_kept": int(kept.sum()),
+            })
+            self.profile_maps(map_set, indices, map_ids, unknown, winner, fallback, timings, matches, level)
+        return unknown & ~assigned
+
+    def report_progress(self, maps):
+        """
+        Count maps as done in the current run, passing the new count on to self.progress
+        """
+        self.maps_done += maps
+        if self.progress is not None:
+            self.progress(self.maps_done, self.maps_total)
+
+    def prepare_output(self, df):
+        """
+        Add new_col and map_id to df as 'unknown' if missing, in the format set by self.compact:
+        strings, categoricals, or int32 codes into a lookup table kept in df.attrs (see decode_output).
+        Existing string columns are converted to that format.
+        """
+        for column in ["new_col", "map_id"]:
+            if self.compact is None:
+                if column not in df.columns:
+                    df[column] = "unknown"
+            elif self.compact == "category":
+                if column not in df.columns:
+                    df[column] = pd.Categorical.from_codes(np.zeros(len(df), dtype=np.int8), ["unknown"])
+                elif not isinstance(df[column].dtype, pd.CategoricalDtype) and output_table(df, column) is None:
+                    df[column] = df[column].astype("category")
+            elif self.compact == "codes":
+                if column not in df.columns:
+                    df[column] = np.zeros(len(df), dtype=np.int32)
+                    set_output_table(df, column, ["unknown"])
+                elif output_table(df, column) is None:
+                    codes, table = pd.factorize(df[column])
+                    df[column] = codes.astype(np.int32)
+                    set_output_table(df, column, list(table))
+            else:
+                raise Exception(f"+--ERROR: {self.compact} is not a valid compact option.--+")
+
+    def unknown_rows(self, df):
+        """
+        Return a boolean array of the rows of df whose new_col is still 'unknown', whatever format new_col is in
+        """
+        table = output_table(df, "new_col")
+        if table is None:
+            return (df["new_col"] == 'unknown').to_numpy(dtype=bool, na_value=False)
+        if "unknown" not in table:
+            return np.zeros(len(df), dtype=bool)
+        return df["new_col"].to_numpy() == table.index("unknown")
+
+    def write_output(self, df, column, rows, table, indices):
+        """
+        Set df[column] at rows (a boolean array) to table[indices], keeping the format of the column (see prepare_output).
+        Labels are looked up once per map rather than once per row.
+        """
+        used = np.unique(indices)
+        labels = table[used]
+        lookup = np.zeros(len(table), dtype=np.int64)
+        values = df[column]
+        codes_table = output_table(df, column)
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            new = pd.Index(labels).unique().difference(values.cat.categories)
+            if len(new):
+                values = values.cat.add_categories(new)
+            lookup[used] = values.cat.categories.get_indexer(labels)
+            codes = values.cat.codes.to_numpy().copy()
+            codes[rows] = lookup[indices]
+            df[column] = pd.Categorical.from_codes(codes, dtype=values.dtype)
+        elif codes_table is not None:
+            positions = dict((label, i) for i, label in enumerate(codes_table))
+            codes_table = codes_table + [label for label in dict.fromkeys(labels) if label not in positions]
+            positions = dict((label, i) for i, label in enumerate(codes_table))
+            lookup[used] = [positions[label] for label in labels]
+            codes = values.to_numpy().copy()
+            codes[rows] = lookup[indices]
+            df[column] = codes
+            set_output_table(df, column, codes_table)
+        else:
+            df.loc[rows, column] = table[indices]
+
+    def profile_maps(self, map_set, indices, map_ids, unknown, winner, fallback, timings, matches, level):
+        """
+        Add the stats of each map of a level to the current run of the profile, counting rows the way running the maps
+        one after the other would: a map's rows in are the unassigned rows no earlier map has won,
+        and its rows matched and assigned are out of those.
+        Maps assigning 'unknown' count the rows they keep as assigned.
+        Everything is counted from the winner and fallback arrays of the level and the matches of the maps run one by one,
+        so no predicate is evaluated again.
+        """
+        run = self.profile.runs[-1]
+        no_map = len(map_set)
+        # unassigned rows by the map that won them (no_map for none), so a map's rows in are a suffix sum
+        won = np.bincount(winner[unknown], minlength=no_map + 1)
+        rows_in = np.cumsum(won[::-1])[::-1]
+        kept = np.bincount(fallback[fallback >= 0], minlength=no_map)
+        for index in indices:
+            map_json_elem = map_set.maps[index]
+            if index in matches:
+                rows_matched = int((winner[matches[index]] >= index).sum())
+            else:
+                # a grouped map is the first map of its group matching the rows it matches within its rows in,
+                # so it wins all of them
+                rows_matched = int(won[index])
+            seconds, map_evaluations, map_saved = timings[index]
+            run["maps"][map_ids[index]] = {
+                "level": level,
+                "grouped": index not in matches,
+                "seconds": seconds,
+                "evaluations": map_evaluations,
+                "evaluations_saved": map_saved,
+                "rows_in": int(rows_in[index]),
+                "rows_matched": rows_matched,
+                "rows_assigned": int(kept[index] if map_json_elem["assign_to"] == 'unknown' else won[index]),
+            }
+        run["evaluations"] += run["levels"][-1]["evaluations"]
+        run["evaluations_saved"] += run["levels"][-1]["evaluations_saved"]
+
+    def evaluate(self, df, maps_found_list):
+        """
+        Run a map set over df without changing it, returning only the new_col and map_id worked out
+        (a frame with the index of df, in the format set by self.compact).
+        The maps run on a lazy copy of the columns they read, so df can be shared by several runs at once.
+        """
+        try:
+            if isinstance(maps_found_list, CompiledMapSet):
+                map_set = maps_found_list
+            else:
+                map_set = CompiledMapSet(maps_found_list)
+            columns = [col for col in map_set.columns if col in df.columns]
+            columns += [col for col in ["new_col", "map_id"] if col in df.columns and col not in columns]
+            # with copy on write the selected columns are shared with df until written to, and only the output columns are
+            frame = self.custom_assignment_processor(df[columns], map_set)
+            if frame is None:
+                return None
+            return frame[["new_col", "map_id"]]
+        except:
+            traceback.print_exc()
+
+    def explain(self, df, maps_found_list):
+        """
+        Dry run of a map set over df (df isn't changed). For each map, report how many rows it matches on its own (matched),
+        how many it assigns in a real run (wins), and which maps assign the rows it matches instead (shadowed_by),
+        plus the number of rows matched by both maps of every pair of maps that share rows (overlaps).
+        Each map's matches are kept as a packed bitset, and the overlaps are counted on the bitsets (see mask_overlaps).
+        """
+        try:
+            if isinstance(maps_found_list, CompiledMapSet):
+                map_set = maps_found_list
+            else:
+                map_set = CompiledMapSet(maps_found_list)
+            map_ids = map_set.map_ids(self.env)
+            compact = self.compact
+            self.compact = "codes"
+            try:
+                output = self.evaluate(df, map_set)
+            finally:
+                self.compact = compact
+            if output is None:
+                raise Exception(f"+--ERROR: Explain - the map set couldn't be run - {self.env}--+")
+            # index of the map that assigned each row, -1 where no map of this map set did
+            position = dict((map_id, index) for index, map_id in enumerate(map_ids))
+            lookup = np.array([position.get(label, -1) for label in output_table(output, "map_id")], dtype=np.int64)
+            winner = lookup[output["map_id"].to_numpy()]
+            wins = np.bincount(winner[winner >= 0], minlength=len(map_set))
+
+            levels = dict((index, level or "default") for level, indices in map_set.schedule(list(df.columns), self.levels) for index in indices)
+            report = {"env": self.env, "rows": len(df), "maps": [], "overlaps": []}
+            owners, positions, words = [], [], []
+            sizes = np.zeros(len(map_set), dtype=np.int64)
+            flipped = np.zeros(len(map_set), dtype=bool)
+            self.column_cache.bind(df)
+            self.map_set = map_set
+            try:
+                for index in range(0, len(map_set)):
+                    if index not in levels:
+                        report["maps"].append({"map_id": map_ids[index], "invalid": True, "error": map_set.errors.get(index, "Key, associated query key or post run is not valid for df")})
+                        continue
+                    map_json_elem = map_set.maps[index]
+                    mask = self.query_mask(df, map_json_elem, map_json_elem["associated_query"])
+                    winners = winner[mask]
+                    shadows = np.bincount(winners[(winners >= 0) & (winners != index)], minlength=len(map_set))
+                    matched = int(np.count_nonzero(mask))
+                    # maps matching most rows are kept as the rows they don't match
+                    flipped[index] = matched * 2 > len(df)
+                    word_positions, word_values = pack_mask(~mask if flipped[index] else mask)
+                    sizes[index] = int(np.bitwise_count(word_values).sum())
+                    owners.append(np.full(len(word_positions), index, dtype=np.int64))
+                    positions.append(word_positions)
+                    words.append(word_values)
+                    report["maps"].append({
+                        "map_id": map_ids[index],
+                        "level": levels[index],
+                        "assign_to": map_json_elem["assign_to"],
+                        "matched": matched,
+                        "wins": int(wins[index]),
+                        "shadowed_by": dict((map_ids[other], int(shadows[other])) for other in np.flatnonzero(shadows)),
+                    })
+            finally:
+                self.column_cache.release()
+                self.map_set = None
+            if owners:
+                first, second, counts = mask_overlaps(np.concatenate(owners), np.concatenate(positions), np.concatenate(words), sizes, flipped, len(df))
+                report["overlaps"] = [{"maps": [map_ids[i], map_ids[j]], "rows": int(count)} for i, j, count in zip(first, second, counts)]
+            return report
+        except:
+            traceback.print_exc()
+
+    def parallel_assignment_processor(self, df, maps_found_list, workers=None, partition_size=100000):
+        """
+        Same as custom_assignment_processor, with the rows split into partitions of partition_size rows
+        that are run in a pool of worker processes (os.cpu_count() when workers is None).
+        The map set is sent to each worker once, and only the columns the maps read are sent with each partition.
+        """
+        try:
+            if isinstance(maps_found_list, CompiledMapSet):
+                map_set = maps_found_list
+            else:
+                map_set = CompiledMapSet(maps_found_list)
+            workers = workers or os.cpu_count() or 1
+            if workers == 1 or len(df) <= partition_size:
+                return self.custom_assignment_processor(df, map_set)
+
+            columns = [col for col in map_set.columns if col in df.columns]
+            columns += [col for col in ["new_col", "map_id"] if col in df.columns and col not in columns]
+            # workers return strings, so partitions are sent with plain string output columns too
+            source = decode_output(df[columns], strings=True)
+            partitions = [source.iloc[start:start + partition_size] for start in range(0, len(df), partition_size)]
+            profile = self.profile is not None
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(self.env, self.levels, map_set, profile)) as pool:
+                results = list(pool.map(_process_partition, partitions))
+            if any(result is None for result in results):
+                raise Exception(f"+--ERROR: Parallel_assignment_processor - a partition failed - {self.env}--+")
+            if profile:
+                self.profile.merge([result[2] for result in results])
+            # partitions come back in order, so the results line up with the rows of df
+            for column, position in [("new_col", 0), ("map_id", 1)]:
+                df[column] = np.concatenate([result[position] for result in results])
+                set_output_table(df, column, None)
+            self.prepare_output(df)
+            return df
+        except:
+            traceback.print_exc()
+
     def map_validator(self, df, mapping=[]):
         try:
             if len(mapping) == 0:
-                for fn in os.listdir(self.map_location):
-                    if self.env.lower() == fn.split(".")[0].lower():
-                        json_map_set = self.map_location + fn 
-                        break 
-
-                mappings = json.loads(open(json_map_set,"r").read())
+                # the compiled map set is cached, so its conflicts are only worked out once per version of the file
+                map_set = load_map_set(self.find_map_set())
+                mappings = map_set.raw
             else:
                 mappings = mapping
-            approved_logic_list = ["contains","equals","not_equals","not_contains", "starts_with"]
             cols = list(df.columns)
             for r in range(0,len(mappings)):
                 key = mappings[r]
                 location = f"\n{self.env}_{r}: {key}"
-                # Validate mapping has appropraite fields 
-                assert ("key" in list(key.keys())), "Key Missing" + location
-                assert ("logic" in list(key.keys())), "Logic Missing" + location
-                assert ("value" in list(key.keys())), "Value Missing" + location
-                assert ("assign_to" in list(key.keys())), "assign_to Missing" + location
+                # Validate mapping has appropraite fields and approved logic
+                check_map_fields(key, location)
 
                 # Is Key is a valid field in DataFrame
                 assert (key["key"] in cols), "Key is not a valid field in df" + location
 
-                # Is Logic in approved logic list 
-                assert (key["logic"].lower() in approved_logic_list), "Logic is not valid" + location
-
                 if ("post_run" in list(key.keys())):
                     assert key["post_run"] in self.levels, "Post run is not valid" + location
                 
                 if ("associated_query" in list(key.keys())) and (len(key["associated_query"])):
                     for i in range(0,len(key["associated_query"])):
-                        child = key["associated_query"][i]
-                        assert ("key" in list(child.keys())), "Associated query key is missing" + location + f"(query at index {i})"
-                        assert ("logic" in list(child.keys())), "Associated query logic is missing" + location + f"(query at index {i})"
-                        assert ("value" in list(child.keys())), "Associated query value is missing" + location + f"(query at index {i})"
                         # Is Key is a valid field in DataFrame
-                        assert (child["key"] in cols), "Associated query key is not valid" + location + f"(query at index {i})"
-                        # Is Logic in approved logic list 
-                        assert (child["logic"].lower() in approved_logic_list), "Associated query logic is not valid" + location + f"(query at index {i})"
+                        assert (key["associated_query"][i]["key"] in cols), "Associated query key is not valid" + location + f"(query at index {i})"
             if len(mappings) > 1 and r == len(mappings) - 1:
-                catches = []
-                for i in range(0,len(mappings)-1):
-                    for j in range(i+1, len(mappings)):
-                        if mappings[i]['value'] in mappings[j]['value'] and mappings[i]['key'] in mappings[j]['key']:
-                            catches.append(f"{self.env}_{i} and {self.env}_{j}")
+                conflicts = map_set.conflicts() if len(mapping) == 0 else find_conflicts(mappings)
+                catches = [f"{self.env}_{i} and {self.env}_{j}" for i, j in conflicts]
                 assert (catches == []), f"The following mappings have conflicts: {catches}"
             return f"Maps given are valid"
         except:
             traceback.print_exc()
     
-    def duplicate_mappings_check(self, path=PATH_TO_MAPS):
+    def duplicate_mappings_check(self, path=PATH_TO_MAPS, cache_path=None):
+        """
+        Find maps that are the same (see canonical_map), within a map file or across the map files in path.
+        Each file is read once and its maps are matched by fingerprint; with a cache_path the fingerprints are saved there
+        and only worked out again for files that have changed since.
+        """
         try:
+            saved = {}
+            if cache_path is not None and os.path.exists(cache_path):
+                with open(cache_path, "r") as f:
+                    saved = json.loads(f.read())
             map_list = []
-            catches = []
-            for fn in os.listdir(path):
+            for fn in sorted(os.listdir(path)):
                 if os.path.isfile(os.path.join(path, fn)):
-                    if 'json' == fn.split(".")[1].lower():
+                    if os.path.splitext(fn)[1].lower() == '.json':
                         map_list.append(fn)
-            for i in range(0, len(map_list)-1):
-                for j in range(i, len(map_list)):
-                    mappings_1 = json.loads(open(path+map_list[i],"r").read())
-                    mappings_2 = json.loads(open(path+map_list[j],"r").read())
-                    for ii in range(0,len(mappings_1)-1):
-                        for jj in range(ii,len(mappings_2)):
-                            if mappings_1[ii] == mappings_2[jj]:
-                                catches.append(f"{map_list[i].split('.')[0]}_{ii} and {map_list[j].split('.')[0]}_{jj}")
+            # fingerprint -> ids of the maps with that fingerprint, in file and map order
+            seen = {}
+            for fn in map_list:
+                for index, fingerprint in enumerate(file_fingerprints(os.path.join(path, fn), saved)):
+                    seen.setdefault(fingerprint, []).append(f"{os.path.splitext(fn)[0]}_{index}")
+            if cache_path is not None:
+                with open(cache_path, "w") as f:
+                    f.write(json.dumps(dict((file_path, _FINGERPRINT_CACHE[file_path]) for file_path in (os.path.abspath(os.path.join(path, fn)) for fn in map_list))))
+            catches = []
+            for map_ids in seen.values():
+                for i in range(0, len(map_ids) - 1):
+                    for j in range(i + 1, len(map_ids)):
+                        catches.append(f"{map_ids[i]} and {map_ids[j]}")
             assert (catches == []), f"The following mappings have conflicts: {catches}"
             return "No duplicates found"
         except:
             traceback.print_exc()
     
-    def print_mapping(self, map_id):
+    def print_mapping(self, map_id, found=None):
+        """
+        Return the map with the given id, its env matched case insensitively (found is passed on to MapRegistry.lookup)
+        """
         try:
-            path = self.map_location + map_id.split("_")[0] + ".json"
-            if os.path.exists(path):
-                json_map_set = path
-            else:
-                map_found = False
-                for fn in os.listdir(self.map_location):
-                    if map_id.split("_")[0] == fn.split(".")[0].lower():
-                        json_map_set = self.map_location + fn
-                        map_found = True 
-                        break 
-                if not map_found:
-                    raise Exception(f"+--ERROR: Map set not found at this path:\n{path}--+")
-            maps_found_list = json.loads(open(json_map_set,"r").read())
-            id = int(map_id.split("_")[1])
-            if id >= 0 and id < len(maps_found_list):
-                return maps_found_list[id]
-            else:
-                raise Exception("+-- Error: Map ID not found --+")
+            return self.registry.lookup(map_id, found)
         except:
             traceback.print_exc()
             return ["Error Finding This Map"]
@@ -274,8 +1612,10 @@ class CustomDFAssigner(object):
     def print_mappings(self,id_list):
         try:
             mappings=[]
+            # map sets already looked up, so each env's file is only checked once
+            found = {}
             for id in id_list:
-                mapping = self.print_mapping(id)
+                mapping = self.print_mapping(id, found)
                 #print(mapping)
                 mappings.append(mapping)
             return mappings
@@ -284,7 +1624,28 @@ class CustomDFAssigner(object):
 
 
 if __name__ == "__main__":
-    print(CustomDFAssigner(env="test").start_processing(
-        df = pd.read_csv("./data.csv")
-    )
-    )
\ No newline at end of file
+    import argparse
+    parser = argparse.ArgumentParser(description="Assign new_col/map_id to the rows of a csv using an env's map file")
+    parser.add_argument("env", nargs="?", default="test")
+    parser.add_argument("input", nargs="?", default="./data.csv")
+    parser.add_argument("--output", help="stream the results to this .csv or .parquet file instead of printing them")
+    parser.add_argument("--chunksize", type=int, default=100000, help="rows read at a time when streaming")
+    parser.add_argument("--additional_check", action="store_true", help="also run extra.json")
+    parser.add_argument("--state", help="only run the maps on rows that changed since the run that saved this state file, then save it again")
+    parser.add_argument("--index_col", help="column identifying each row across runs with --state (row number by default)")
+    args = parser.parse_args()
+    if args.output:
+        print(CustomDFAssigner(env=args.env).stream_csv(args.input, args.output, args.chunksize, args.additional_check))
+    elif args.state:
+        print(CustomDFAssigner(env=args.env).incremental_processing(
+            df = pd.read_csv(args.input, index_col=args.index_col),
+            additional_check = args.additional_check,
+            state_path = args.state
+        )
+        )
+    else:
+        print(CustomDFAssigner(env=args.env).start_processing(
+            df = pd.read_csv(args.input),
+            additional_check = args.additional_check
+        )
+        )
\ No newline at end of file
@@ -0,0 +1,139 @@
+import os
+import shutil
+import tempfile
+import threading
+import pandas as pd
+
+PATH_TO_DATASETS = "./datasets/"
+
+class DatasetStore(object):
+    """
+    Numbered versions of a dataset, each written once to root as an Arrow IPC file and never changed after,
+    and loaded memory mapped so a version is only read from disk as its columns are used (needs pyarrow).
+    One version is current at a time. Frames handed out by snapshot() stay as they are when the current version changes,
+    so readers keep the version they started with.
+    """
+    def __init__(self, root=PATH_TO_DATASETS, keep=10):
+        os.makedirs(root, exist_ok=True)
+        self.root = root
+        self.keep = keep #versions kept on disk, besides the current and base versions
+        self.lock = threading.Lock()
+        self.frames = {} #version -> loaded frame
+        self.versions = sorted(int(fn[1:-6]) for fn in os.listdir(root) if fn.startswith("v") and fn.endswith(".arrow") and fn[1:-6].isdigit())
+        self.current = None #(frame, version)
+        self.base = None #version /reset_data goes back to
+
+    def path(self, version):
+        return os.path.join(self.root, f"v{version}.arrow")
+
+    def add_frame(self, df, source=None):
+        """
+        Save df as a new version and return its number. source is kept in the file's metadata (see add_base).
+        """
+        import pyarrow as pa
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        # pandas strings are backed by large_string arrays, so those are loaded without a copy
+        table = table.cast(pa.schema([field.with_type(pa.large_string()) if pa.types.is_string(field.type) else field for field in table.schema], metadata=table.schema.metadata))
+        if source is not None:
+            table = table.replace_schema_metadata(dict(table.schema.metadata or {}, source=source))
+        with self.lock:
+            version = (self.versions[-1] + 1) if self.versions else 1
+            self.versions.append(version)
+        # written whole under a temporary name first, so a version file is either complete or missing
+        fd, temp_path = tempfile.mkstemp(dir=self.root, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                with pa.ipc.new_file(f, table.schema) as writer:
+                    # one record batch, so numeric columns are loaded without a copy too
+                    writer.write_table(table.combine_chunks())
+            os.replace(temp_path, self.path(version))
+        except:
+            os.remove(temp_path)
+            with self.lock:
+                self.versions.remove(version)
+            raise
+        self.prune()
+        return version
+
+    def add_csv(self, source, source_id=None):
+        """
+        Save a csv, a path or a binary file object (e.g. an upload, copied to disk a block at a time), as a new version
+        """
+        if isinstance(source, str):
+            return self.add_frame(pd.read_csv(source), source_id)
+        fd, temp_path = tempfile.mkstemp(dir=self.root, suffix=".csv")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                shutil.copyfileobj(source, f, 1 << 20)
+            return self.add_frame(pd.read_csv(temp_path), source_id)
+        finally:
+            os.remove(temp_path)
+
+    def add_base(self, path):
+        """
+        Make the csv at path the base version, only converting it when no version was made from this file as it is now
+        """
+        stat = os.stat(path)
+        source = f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+        import pyarrow as pa
+        for version in reversed(self.versions):
+            with pa.memory_map(self.path(version)) as f:
+                metadata = pa.ipc.open_file(f).schema.metadata or {}
+            if metadata.get(b"source") == source.encode("utf-8"):
+                break
+        else:
+            version = self.add_csv(path, source)
+        self.base = version
+        return version
+
+    def load(self, version):
+        """
+        The frame of a version, memory mapped
+        """
+        with self.lock:
+            if version in self.frames:
+                return self.frames[version]
+            if version not in self.versions:
+                raise KeyError(f"Dataset version {version} not found")
+        import pyarrow as pa
+        table = pa.ipc.open_file(pa.memory_map(self.path(version))).read_all()
+        # the frame's columns are views of the mapped file where pandas can use the Arrow data as it is
+        frame = table.to_pandas(split_blocks=True)
+        with self.lock:
+            return self.frames.setdefault(version, frame)
+
+    def switch(self, version):
+        """
+        Make a version the current one
+        """
+        frame = self.load(version)
+        with self.lock:
+            self.current = (frame, version)
+        return version
+
+    def reset(self):
+        return self.switch(self.base)
+
+    def snapshot(self):
+        """
+        The current frame and its version
+        """
+        with self.lock:
+            return self.current
+
+    def prune(self):
+        """
+        Delete the oldest versions beyond keep, never the current or base version.
+        Frames already loaded from a deleted version still work, as the file stays mapped until they are gone.
+        """
+        with self.lock:
+            kept = set([self.base, self.current[1] if self.current else None])
+            old = [version for version in self.versions if version not in kept]
+            for version in old[:max(0, len(old) - self.keep)]:
+                try:
+                    os.remove(self.path(version))
+                except OSError:
+                    # files that are mapped can't be deleted on some platforms, they go on the next prune
+                    continue
+                self.versions.remove(version)
+                self.frames.pop(version, None)
@@ -0,0 +1,82 @@
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+class Job(object):
+    """
+    One submission to a JobQueue: its status (queued, running, done or failed), progress and result
+    """
+    def __init__(self, key):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.status = "queued"
+        self.maps_done = 0
+        self.maps_total = None
+        self.result = None
+        self.error = None
+        self.submitted = time.time()
+        self.finished = None
+
+    def progress(self, done, total):
+        self.maps_done, self.maps_total = done, total
+
+    def report(self):
+        report = {"job_id": self.id, "status": self.status, "maps_done": self.maps_done, "maps_total": self.maps_total}
+        if self.error is not None:
+            report["error"] = self.error
+        return report
+
+class JobQueue(object):
+    """
+    Runs jobs on a pool of at most workers threads. Jobs are keyed, and submitting a key that is already queued, running
+    or done gives back that job instead of running it again. Only the last max_results finished jobs are kept.
+    """
+    def __init__(self, workers=2, max_results=32):
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.max_results = max_results
+        self.jobs = OrderedDict() #job id -> job, oldest first
+        self.by_key = {} #key -> id of the job for it
+        self.lock = threading.Lock()
+
+    def submit(self, key, run):
+        """
+        Queue run(job) for key, which returns the job's result and can call job.progress as it goes.
+        Returns (job, True) when a job for key already exists, else (new job, False).
+        """
+        with self.lock:
+            if key in self.by_key:
+                job = self.jobs[self.by_key[key]]
+                self.jobs.move_to_end(job.id)
+                return job, True
+            job = Job(key)
+            self.jobs[job.id] = job
+            self.by_key[key] = job.id
+        self.pool.submit(self.execute, job, run)
+        return job, False
+
+    def execute(self, job, run):
+        job.status = "running"
+        try:
+            job.result = run(job)
+            job.status = "done"
+        except Exception as err:
+            traceback.print_exc()
+            job.error = str(err)
+            job.status = "failed"
+        job.finished = time.time()
+        with self.lock:
+            # failed jobs are run again when submitted again
+            if job.status == "failed" and self.by_key.get(job.key) == job.id:
+                del self.by_key[job.key]
+            finished = [other for other in self.jobs.values() if other.finished is not None]
+            for other in finished[:max(0, len(finished) - self.max_results)]:
+                del self.jobs[other.id]
+                if self.by_key.get(other.key) == other.id:
+                    del self.by_key[other.key]
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
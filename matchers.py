@@ -0,0 +1,111 @@
+import numpy as np
+from bisect import bisect_left
+from collections import deque
+
+class AhoCorasick(object):
+    """
+    Aho-Corasick automaton over a set of substrings, reporting every pattern found in a string in one pass over it
+    """
+    def __init__(self, patterns):
+        self.patterns = list(dict.fromkeys(patterns))
+        self.index = dict((pattern, i) for i, pattern in enumerate(self.patterns))
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [[]]
+        for i, pattern in enumerate(self.patterns):
+            node = 0
+            for ch in pattern:
+                if ch not in self.goto[node]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append([])
+                    self.goto[node][ch] = len(self.goto) - 1
+                node = self.goto[node][ch]
+            self.out[node].append(i)
+        # breadth first so the fail link of a node's parent is always set before the node itself
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, child in self.goto[node].items():
+                queue.append(child)
+                state = self.fail[node]
+                while state and ch not in self.goto[state]:
+                    state = self.fail[state]
+                self.fail[child] = self.goto[state].get(ch, 0)
+                self.out[child] = self.out[child] + self.out[self.fail[child]]
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def search(self, text):
+        """
+        Return the indices of all patterns that occur in text
+        """
+        goto, fail, out = self.goto, self.fail, self.out
+        found = set(out[0])
+        node = 0
+        for ch in text:
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            if out[node]:
+                found.update(out[node])
+        return found
+
+    def masks(self, values):
+        """
+        Scan each value once and return {pattern: boolean array over values} for every pattern.
+        Values that aren't strings (e.g. NaN) match nothing.
+        """
+        hits = [[] for _ in self.patterns]
+        for position, text in enumerate(values):
+            if isinstance(text, str):
+                for i in self.search(text):
+                    hits[i].append(position)
+        masks = {}
+        for i, pattern in enumerate(self.patterns):
+            mask = np.zeros(len(values), dtype=bool)
+            mask[hits[i]] = True
+            masks[pattern] = mask
+        return masks
+
+class PrefixIndex(object):
+    """
+    The distinct values of a column in sorted order, so the values starting with a prefix are found with a binary search
+    """
+    def __init__(self, values):
+        self.size = len(values)
+        # values that aren't strings (e.g. NaN) never start with anything
+        self.order = sorted((i for i in range(0, self.size) if isinstance(values[i], str)), key=values.__getitem__)
+        self.sorted = [values[i] for i in self.order]
+        self.order = np.array(self.order, dtype=np.int64)
+
+    def span(self, prefix):
+        """
+        Return the positions (in the original values) of the values starting with prefix
+        """
+        lo = bisect_left(self.sorted, prefix)
+        # every value starting with prefix sorts before the prefix with its last character bumped up
+        upper = prefix.rstrip(chr(0x10FFFF))
+        if upper == "":
+            return self.order[lo:]
+        hi = bisect_left(self.sorted, upper[:-1] + chr(ord(upper[-1]) + 1))
+        return self.order[lo:hi]
+
+    def mask(self, prefix):
+        """
+        Return a boolean array over the values (plus a trailing False) of the values starting with prefix
+        """
+        mask = np.zeros(self.size + 1, dtype=bool)
+        mask[self.span(prefix)] = True
+        return mask
+
+    def first_match(self, prefixes, no_match):
+        """
+        For a list of (prefix, id) sorted by id, return an array over the values (plus a trailing no_match)
+        holding the lowest id whose prefix each value starts with, or no_match
+        """
+        found = np.full(self.size + 1, no_match, dtype=np.int64)
+        for prefix, id in reversed(prefixes):
+            found[self.span(prefix)] = id
+        return found
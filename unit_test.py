@@ -1,8 +1,18 @@
 import pytest 
 import pandas as pd
 import json
+import os
+import tempfile
+import time
 
-from custom_map_assignment import CustomDFAssigner
+from custom_map_assignment import CustomDFAssigner, CompiledMapSet, ColumnCache, MapRegistry, RunProfile, decode_output, load_map_set, find_conflicts, pack_mask, mask_overlaps, output_chunks
+from matchers import AhoCorasick
+from jobs import JobQueue
+from dataset_store import DatasetStore
+import benchmark
+
+# versions saved by the app's dataset store go to a scratch folder, not ./datasets/
+os.environ["DATASETS_PATH"] = tempfile.mkdtemp()
 
 class Test_start_processing():
     """
@@ -62,6 +72,77 @@ class Test_start_processing():
         assert group_count['test'] == 1, "Test 2 failed - wrong group"
         assert id_count['t1_0'] == 1, "Test 2 failed - wrong map id"
 
+    def test_6(self):
+        """
+        test that dedupe mode gives the same df as a full run, including missing values and the additional check
+        """
+        df = pd.DataFrame.from_dict({'A': ['a','d','x',None]*3, 'B': ['b','e','y','b']*3, 'C': ['c','f','z','c']*3, 'D': range(12)})
+        expected = CustomDFAssigner("t1",maps_loc="./unit_test_mappings/").start_processing(df.copy(),True)
+        updated = CustomDFAssigner("t1",maps_loc="./unit_test_mappings/").start_processing(df.copy(),True,dedupe=True)
+        assert updated.equals(expected), "Test 6 failed - result differs from full run"
+
+    def test_7(self):
+        """
+        test that dedupe mode only runs the maps on the distinct key combinations
+        """
+        df = pd.DataFrame.from_dict({'A': ['a','d','x']*4, 'B': ['b','e','y']*4, 'C': ['c','f','z']*4, 'D': range(12)})
+        assigner = CustomDFAssigner("t1",maps_loc="./unit_test_mappings/")
+        target, groups = assigner.dedupe_rows(df, ["A"])
+        assert len(target) == 3 and list(groups) == [0,1,2]*4, "Test 7 failed - wrong combinations"
+
+class Test_stream_csv():
+    """
+    Test the method 'stream_csv' for valid and invalid scenarios
+    (dependent on custom_assignment_processor)
+    """
+    def test_1(self):
+        """
+        test that streaming in chunks gives the same rows as start_processing, including the additional check
+        """
+        df = pd.DataFrame.from_dict({'A': ['a','d','x'], 'B': ['b','e','y'], 'C': ['c','f','z']})
+        folder = tempfile.mkdtemp()
+        df.to_csv(os.path.join(folder, "in.csv"), index=False)
+        rows = CustomDFAssigner("t1",maps_loc="./unit_test_mappings/").stream_csv(os.path.join(folder, "in.csv"), os.path.join(folder, "out.csv"), chunksize=2, additional_check=True)
+        expected = CustomDFAssigner("t1",maps_loc="./unit_test_mappings/").start_processing(df,True)
+        assert rows == 3, "Test 1 failed - wrong row count"
+        assert pd.read_csv(os.path.join(folder, "out.csv")).equals(expected), "Test 1 failed - wrong rows written"
+
+    def test_2(self):
+        """
+        test that it won't stream if it can't find the mapping
+        """
+        folder = tempfile.mkdtemp()
+        pd.DataFrame.from_dict({'A': ['a']}).to_csv(os.path.join(folder, "in.csv"), index=False)
+        rows = CustomDFAssigner("p1",maps_loc="./unit_test_mappings/").stream_csv(os.path.join(folder, "in.csv"), os.path.join(folder, "out.csv"))
+        assert rows is None, "Test 2 failed - loading wrong json"
+        assert not os.path.exists(os.path.join(folder, "out.csv")), "Test 2 failed - output written"
+
+    def test_3(self):
+        """
+        test that compact output columns are written out as strings
+        """
+        df = pd.DataFrame.from_dict({'A': ['a','d','x'], 'B': ['b','e','y'], 'C': ['c','f','z']})
+        folder = tempfile.mkdtemp()
+        df.to_csv(os.path.join(folder, "in.csv"), index=False)
+        assigner = CustomDFAssigner("t1",maps_loc="./unit_test_mappings/")
+        assigner.compact = "codes"
+        assigner.stream_csv(os.path.join(folder, "in.csv"), os.path.join(folder, "out.csv"), chunksize=2, additional_check=True)
+        assert list(pd.read_csv(os.path.join(folder, "out.csv"))["map_id"]) == ["t1_0","extra_0","unknown"], "Test 3 failed - codes written"
+
+    def test_4(self):
+        """
+        test that a chunk where a key column is all missing is streamed, to csv and to parquet
+        """
+        df = pd.DataFrame.from_dict({'A': ['a','b',None,None,None,None,'a'], 'B': ['b','e','y','k','z','q','q'], 'C': ['c']*7})
+        folder = tempfile.mkdtemp()
+        df.to_csv(os.path.join(folder, "in.csv"), index=False)
+        expected = CustomDFAssigner("t1",maps_loc="./unit_test_mappings/").start_processing(pd.read_csv(os.path.join(folder, "in.csv")))
+        rows = CustomDFAssigner("t1",maps_loc="./unit_test_mappings/").stream_csv(os.path.join(folder, "in.csv"), os.path.join(folder, "out.csv"), chunksize=2)
+        assert rows == 7 and pd.read_csv(os.path.join(folder, "out.csv")).equals(expected), "Test 4 failed - wrong csv"
+        pytest.importorskip("pyarrow")
+        rows = CustomDFAssigner("t1",maps_loc="./unit_test_mappings/").stream_csv(os.path.join(folder, "in.csv"), os.path.join(folder, "out.parquet"), chunksize=2)
+        assert rows == 7 and list(pd.read_parquet(os.path.join(folder, "out.parquet"))["map_id"]) == list(expected["map_id"]), "Test 4 failed - wrong parquet"
+
 class Test_logic_parser():
     """
     test the method 'logic_parser' for valid and invalid scenarios
@@ -127,6 +208,22 @@ class Test_logic_parser():
         updated = CustomDFAssigner("t1").logic_parser(df, mapping[0]["logic"], mapping[0]["key"], mapping[0]["value"])
         assert updated is None, "Test 6 failed - Logic Parser using incorrect logic"
 
+    def test_7(self):
+        """
+        test that a list value keeps rows with identical content and the original row order
+        """
+        df = pd.DataFrame.from_dict({'A': ['x','a','x'], 'B': ['y','b','y'], 'C': ['z','c','z']})
+        updated = CustomDFAssigner("t1").logic_parser(df, "equals", "A", ["x","a"])
+        assert list(updated.index) == [0,1,2], "Test 7 failed - rows merged or reordered"
+
+    def test_8(self):
+        """
+        test that predicate masks are boolean arrays over the given df
+        """
+        df = pd.DataFrame.from_dict({'A': ['a','d',None], 'B': ['b','e','y'], 'C': ['c','f','z']})
+        mask = CustomDFAssigner("t1").predicate_mask(df, "starts_with", "A", ["a","d"])
+        assert mask.tolist() == [True, True, False], "Test 8 failed - wrong mask"
+
 class Test_run_map_config():
     """
     Test the method 'run_map_config' for valid and invalid scenarios
@@ -278,6 +375,631 @@ class Test_custom_assignment_processor():
         assert group_count['test'] == 1, "Test 9 failed"
         assert id_count['t8_0'] == 1, "Test 9 failed"
         
+class Test_dispatch():
+    """
+    Test the grouped lookups used for equals maps without associated queries
+    """
+    def test_1(self):
+        """
+        test that equals maps on the same key are grouped into one lookup
+        """
+        mapping = json.loads(open("./unit_test_mappings/dispatch/t1.json","r").read())
+        singles, groups = CompiledMapSet(mapping).dispatch([0,1,2,3])
+        assert singles == [0], "Test 1 failed - wrong maps run one by one"
+        assert groups == {("equals", "A"): {"a": 1, "x": 1, "d": 3}}, "Test 1 failed - wrong lookup"
+
+    def test_2(self):
+        """
+        test that grouped maps keep first match wins and their map ids
+        """
+        df = pd.DataFrame.from_dict({'A': ['a','D','x','q'], 'B': ['b','e','y','w']})
+        mapping = json.loads(open("./unit_test_mappings/dispatch/t1.json","r").read())
+        updated = CustomDFAssigner("t1").custom_assignment_processor(df,mapping)
+        assert list(updated["new_col"]) == ["second","fourth","first","unknown"], "Test 2 failed - wrong group"
+        assert list(updated["map_id"]) == ["t1_1","t1_3","t1_0","unknown"], "Test 2 failed - wrong map id"
+
+class Test_schedule():
+    """
+    Test the level buckets the maps of a map set are run in
+    """
+    def test_1(self):
+        """
+        test that maps are bucketed by post_run level in run order, leaving out invalid maps
+        """
+        mapping = json.loads(open("./unit_test_mappings/t6.json","r").read())
+        mapping.append({"key":"D","logic":"equals","value":"a","assign_to":"test"})
+        schedule = CompiledMapSet(mapping).schedule(["A","B","C"], ["L1","L2"])
+        assert schedule == [(None, [2]), ("L1", [1]), ("L2", [0])], "Test 1 failed - wrong buckets"
+
+    def test_2(self):
+        """
+        test that later levels are skipped once every row is assigned
+        """
+        df = pd.DataFrame.from_dict({'A': ['a','a'], 'B': ['k','k'], 'C': ['q','q']})
+        mapping = json.loads(open("./unit_test_mappings/t6.json","r").read())
+        assigner = CustomDFAssigner("t6")
+        assigner.profile = RunProfile()
+        updated = assigner.custom_assignment_processor(df,mapping)
+        assert list(updated["map_id"]) == ["t6_2","t6_2"], "Test 2 failed - wrong map id"
+        assert [level["level"] for level in assigner.profile.runs[0]["levels"]] == ["default"], "Test 2 failed - later levels were run"
+
+class Test_compact():
+    """
+    Test the categorical and integer coded new_col/map_id output
+    """
+    def test_1(self):
+        """
+        test that categorical output has the same values as string output, over post run levels
+        """
+        df = pd.DataFrame.from_dict({'A': ['a','d','x','a','b'], 'B': ['b','e','y','k','z'], 'C': ['c','f','z','q','q']})
+        mapping = json.loads(open("./unit_test_mappings/t6.json","r").read())
+        expected = CustomDFAssigner("t6").custom_assignment_processor(df.copy(),mapping)
+        assigner = CustomDFAssigner("t6")
+        assigner.compact = "category"
+        updated = assigner.custom_assignment_processor(df.copy(),mapping)
+        assert isinstance(updated["map_id"].dtype, pd.CategoricalDtype), "Test 1 failed - map_id not categorical"
+        assert list(updated["map_id"]) == list(expected["map_id"]) and list(updated["new_col"]) == list(expected["new_col"]), "Test 1 failed - wrong values"
+
+    def test_2(self):
+        """
+        test that int32 codes with lookup tables decode to the string output, including the additional check and dedupe
+        """
+        df = pd.DataFrame.from_dict({'A': ['a','d','x']*2, 'B': ['b','e','y']*2, 'C': ['c','f','z']*2})
+        assigner = CustomDFAssigner("t1",maps_loc="./unit_test_mappings/")
+        assigner.compact = "codes"
+        updated = assigner.start_processing(df.copy(),True,dedupe=True)
+        assert updated["map_id"].dtype == "int32", "Test 2 failed - map_id not coded"
+        decoded = decode_output(updated, strings=True)
+        assert list(decoded["map_id"]) == ["t1_0","extra_0","unknown"]*2, "Test 2 failed - wrong map id"
+        assert "codes" not in decoded.attrs and "codes" in updated.attrs, "Test 2 failed - lookup tables not kept apart"
+
+class Test_evaluate():
+    """
+    Test running a map set without changing the df
+    """
+    def test_1(self):
+        """
+        test that only new_col and map_id are returned, with the values of a normal run, and that df isn't changed
+        """
+        df = pd.DataFrame.from_dict({'A': ['a','d','x','a','b'], 'B': ['b','e','y','k','z'], 'C': ['c','f','z','q','q']})
+        mapping = json.loads(open("./unit_test_mappings/t6.json","r").read())
+        expected = CustomDFAssigner("t6").custom_assignment_processor(df.copy(),mapping)
+        output = CustomDFAssigner("t6").evaluate(df,mapping)
+        assert list(output.columns) == ["new_col","map_id"], "Test 1 failed - wrong columns"
+        assert list(output["new_col"]) == list(expected["new_col"]) and list(output["map_id"]) == list(expected["map_id"]), "Test 1 failed - wrong values"
+        assert list(df.columns) == ['A','B','C'], "Test 1 failed - df changed"
+
+    def test_2(self):
+        """
+        test that coded output joined to df a chunk at a time gives the frame of a normal run
+        """
+        df = pd.DataFrame.from_dict({'A': ['a','d','x','a','b'], 'B': ['b','e','y','k','z'], 'C': ['c','f','z','q','q']})
+        mapping = json.loads(open("./unit_test_mappings/t6.json","r").read())
+        expected = CustomDFAssigner("t6").custom_assignment_processor(df.copy(),mapping)
+        assigner = CustomDFAssigner("t6")
+        assigner.compact = "codes"
+        joined = pd.concat(list(output_chunks(df, assigner.evaluate(df,mapping), chunksize=2)))
+        assert joined.to_csv(index=False) == expected.to_csv(index=False), "Test 2 failed - wrong joined frame"
+
+class Test_stream():
+    """
+    Test the streamed responses of the Flask app
+    """
+    def test_1(self):
+        """
+        test that /run_mapping streams the csv of a normal run in chunks, gzipped when asked for
+        """
+        import app
+        import gzip
+        df = pd.DataFrame.from_dict({'A': ['a','d','x','a','b'], 'B': ['b','e','y','k','z'], 'C': ['c','f','z','q','q']})
+        mapping = json.loads(open("./unit_test_mappings/t1.json","r").read())
+        expected = CustomDFAssigner("API").custom_assignment_processor(df.copy(),mapping).to_csv(index=False)
+        app.STREAM_ROWS = 2
+        app.set_data_frame(df)
+        client = app.app.test_client()
+        response = client.post("/run_mapping", json=mapping)
+        assert response.is_streamed and response.data.decode() == expected, "Test 1 failed - wrong csv"
+        response = client.post("/run_mapping", json=mapping, headers={"Accept-Encoding": "gzip"})
+        assert gzip.decompress(response.data).decode() == expected, "Test 1 failed - wrong gzipped csv"
+
+    def test_2(self):
+        """
+        test that /view_data streams Arrow IPC when asked for in the Accept header
+        """
+        import app
+        pa = pytest.importorskip("pyarrow")
+        df = pd.DataFrame.from_dict({'A': ['a','d','x','a','b'], 'B': ['b','e','y','k','z']})
+        app.STREAM_ROWS = 2
+        app.set_data_frame(df)
+        response = app.app.test_client().get("/view_data", headers={"Accept": "application/vnd.apache.arrow.stream"})
+        assert response.mimetype == "application/vnd.apache.arrow.stream", "Test 2 failed - wrong format"
+        assert pa.ipc.open_stream(response.data).read_all().to_pandas().equals(df), "Test 2 failed - wrong data"
+
+def wait_for(job, seconds=10):
+    started = time.time()
+    while job.status in ["queued", "running"] and time.time() - started < seconds:
+        time.sleep(0.01)
+    return job
+
+class Test_jobs():
+    """
+    Test the job queue behind /submit_mapping
+    """
+    def test_1(self):
+        """
+        test that a key is only run once while its job is kept, that failed jobs run again, and that old results are dropped
+        """
+        queue = JobQueue(workers=1, max_results=2)
+        runs = []
+        def run(job):
+            runs.append(job.key)
+            job.progress(1, 1)
+            if job.key == "bad":
+                raise Exception("bad mapping")
+            return job.key.upper()
+        job, cached = queue.submit("a", run)
+        assert not cached and wait_for(job).result == "A" and job.report()["maps_done"] == 1, "Test 1 failed - job not run"
+        assert queue.submit("a", run) == (job, True), "Test 1 failed - job run again"
+        bad, _ = queue.submit("bad", run)
+        assert wait_for(bad).status == "failed" and bad.report()["error"] == "bad mapping", "Test 1 failed - failure not reported"
+        assert not wait_for(queue.submit("bad", run)[0]) is bad, "Test 1 failed - failed job not run again"
+        wait_for(queue.submit("c", run)[0])
+        assert queue.get(job.id) is None and not queue.submit("a", run)[1], "Test 1 failed - old result kept"
+
+    def test_2(self):
+        """
+        test submitting a mapping, polling its progress and fetching the csv of a normal run, and the cached result
+        """
+        import app
+        df = pd.DataFrame.from_dict({'A': ['a','d','x','a','b'], 'B': ['b','e','y','k','z'], 'C': ['c','f','z','q','q']})
+        mapping = json.loads(open("./unit_test_mappings/t1.json","r").read())
+        expected = CustomDFAssigner("API").custom_assignment_processor(df.copy(),mapping).to_csv(index=False)
+        app.set_data_frame(df)
+        client = app.app.test_client()
+        response = client.post("/submit_mapping", json=mapping)
+        assert response.status_code == 202, "Test 2 failed - job not queued"
+        wait_for(app.jobs.get(response.json["job_id"]))
+        status = client.get(f"/job_status/{response.json['job_id']}").json
+        assert status["status"] == "done" and status["maps_done"] == status["maps_total"] == len(mapping), "Test 2 failed - wrong progress"
+        assert client.get(f"/job_result/{response.json['job_id']}").data.decode() == expected, "Test 2 failed - wrong result"
+        again = client.post("/submit_mapping", json=mapping)
+        assert again.status_code == 200 and again.json["job_id"] == response.json["job_id"], "Test 2 failed - result not cached"
+
+    def test_3(self):
+        """
+        test that a mapping the engine rejects doesn't share a job with a valid mapping it differs from only in spacing
+        """
+        import app
+        df = pd.DataFrame.from_dict({'A': ['a','d']})
+        expected = CustomDFAssigner("API").custom_assignment_processor(df.copy(),[{"key":"A","logic":"equals","value":"a","assign_to":"g"}]).to_csv(index=False)
+        app.set_data_frame(df)
+        client = app.app.test_client()
+        invalid = client.post("/submit_mapping", json=[{"key":"A","logic":" equals","value":"a","assign_to":"g"}])
+        valid = client.post("/submit_mapping", json=[{"key":"A","logic":"equals","value":"a","assign_to":"g"}])
+        assert valid.status_code == 202 and valid.json["job_id"] != invalid.json["job_id"], "Test 3 failed - mappings share a job"
+        wait_for(app.jobs.get(valid.json["job_id"]))
+        assert client.get(f"/job_result/{valid.json['job_id']}").data.decode() == expected, "Test 3 failed - wrong result"
+
+class Test_dataset_store():
+    """
+    Test the versions of the data kept by the Flask app
+    """
+    def test_1(self):
+        """
+        test that a frame taken before the current version changes stays the same, and switching back and forth
+        """
+        pytest.importorskip("pyarrow")
+        with tempfile.TemporaryDirectory() as folder:
+            store = DatasetStore(folder)
+            first = pd.DataFrame.from_dict({'A': ['a','d',None], 'B': [1,2,3], 'C': [0.5,None,1.5]})
+            version = store.switch(store.add_frame(first))
+            frame, _ = store.snapshot()
+            second = store.switch(store.add_csv(open("./data.csv","rb")))
+            assert frame.equals(first) and store.snapshot()[0].equals(pd.read_csv("./data.csv")), "Test 1 failed - wrong data"
+            assert store.switch(version) == version and store.snapshot()[0] is frame, "Test 1 failed - version not switched back"
+            with pytest.raises(KeyError):
+                store.switch(second + 1)
+
+    def test_2(self):
+        """
+        test that the base csv is only converted again once it changes, and that old versions are pruned
+        """
+        pytest.importorskip("pyarrow")
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "data.csv")
+            pd.DataFrame.from_dict({'A': ['a','d']}).to_csv(path, index=False)
+            base = DatasetStore(folder).add_base(path)
+            store = DatasetStore(folder, keep=1)
+            assert store.add_base(path) == base, "Test 2 failed - base converted again"
+            pd.DataFrame.from_dict({'A': ['x']}).to_csv(path, index=False)
+            os.utime(path, ns=(0, 0))
+            changed = store.add_base(path)
+            assert changed != base and store.reset() == changed, "Test 2 failed - changed base not converted"
+            store.add_frame(pd.DataFrame.from_dict({'A': ['y']}))
+            store.add_frame(pd.DataFrame.from_dict({'A': ['z']}))
+            assert len(store.versions) == 2 and list(store.snapshot()[0]["A"]) == ['x'], "Test 2 failed - wrong versions kept"
+
+class Test_incremental():
+    """
+    Test running the maps only on rows that changed since a previous run
+    """
+    def test_1(self):
+        """
+        test that only new and changed rows are run, with a state file, and the result is that of a full run
+        """
+        df = pd.DataFrame.from_dict({'A': ['a','d','x','a','b'], 'B': ['b','e','y','k','z'], 'C': ['c','f','z','q','q']})
+        df.index = [10, 11, 12, 13, 14]
+        with tempfile.TemporaryDirectory() as folder:
+            state_path = os.path.join(folder, "state.pkl")
+            assigner = CustomDFAssigner("t6",maps_loc="./unit_test_mappings/")
+            assigner.incremental_processing(df.copy(), state_path=state_path)
+            assert assigner.rows_evaluated == 5, "Test 1 failed - first run not full"
+            updated = pd.concat([df.drop(index=[10]), pd.DataFrame({'A': ['a'], 'B': ['b'], 'C': ['c']}, index=[15])])
+            updated.loc[12, "A"] = "a"
+            assigner = CustomDFAssigner("t6",maps_loc="./unit_test_mappings/")
+            result = assigner.incremental_processing(updated.copy(), state_path=state_path)
+            expected = CustomDFAssigner("t6",maps_loc="./unit_test_mappings/").start_processing(updated.copy())
+            assert assigner.rows_evaluated == 2, "Test 1 failed - wrong rows run"
+            assert result.equals(expected), "Test 1 failed - wrong result"
+
+    def test_2(self):
+        """
+        test that a previous result df is reused, and that every row is run again once the map file changes
+        """
+        df = pd.DataFrame.from_dict({'A': ['a','d','x'], 'B': ['b','e','y'], 'C': ['c','f','z']})
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "t1.json")
+            with open(path, "w") as f:
+                json.dump([{"key":"A","logic":"equals","value":"a","assign_to":"test"}], f)
+            previous = CustomDFAssigner("t1",maps_loc=folder).incremental_processing(df.copy())
+            assigner = CustomDFAssigner("t1",maps_loc=folder)
+            assert list(assigner.incremental_processing(df.copy(), previous)["map_id"]) == ["t1_0","unknown","unknown"] and assigner.rows_evaluated == 0, "Test 2 failed - previous df not reused"
+            with open(path, "w") as f:
+                json.dump([{"key":"A","logic":"equals","value":"d","assign_to":"test"}, {"key":"B","logic":"equals","value":"b","assign_to":"test"}], f)
+            assigner = CustomDFAssigner("t1",maps_loc=folder)
+            assert list(assigner.incremental_processing(df.copy(), previous)["map_id"]) == ["t1_1","t1_0","unknown"] and assigner.rows_evaluated == 3, "Test 2 failed - changed maps not run"
+
+    def test_3(self):
+        """
+        test that with profile the report of the rows that were run is returned along with the df
+        """
+        df = pd.DataFrame.from_dict({'A': ['a','d','x'], 'B': ['b','e','y'], 'C': ['c','f','z']})
+        previous, report = CustomDFAssigner("t1",maps_loc="./unit_test_mappings/").incremental_processing(df.copy(), profile=True)
+        assert list(previous["map_id"]) == ["t1_0","unknown","unknown"], "Test 3 failed - wrong map id"
+        assert [run["rows"] for run in report["runs"]] == [3], "Test 3 failed - wrong report"
+        df.loc[1, "A"] = "a"
+        updated, report = CustomDFAssigner("t1",maps_loc="./unit_test_mappings/").incremental_processing(df.copy(), previous, profile=True)
+        assert list(updated["map_id"]) == ["t1_0","t1_0","unknown"], "Test 3 failed - wrong map id"
+        assert [run["rows"] for run in report["runs"]] == [1], "Test 3 failed - wrong report"
+
+class Test_explain():
+    """
+    Test the explain dry run
+    """
+    def test_1(self):
+        """
+        test the matches, wins, shadows and overlaps of each map, and that df isn't changed
+        """
+        df = pd.DataFrame.from_dict({'A': ['a','D','x','q'], 'B': ['b','e','y','w']})
+        mapping = json.loads(open("./unit_test_mappings/dispatch/t1.json","r").read())
+        report = CustomDFAssigner("t1").explain(df,mapping)
+        counts = [(m["map_id"], m["matched"], m["wins"], m["shadowed_by"]) for m in report["maps"]]
+        assert counts == [("t1_0", 1, 1, {}), ("t1_1", 2, 1, {"t1_0": 1}), ("t1_2", 1, 0, {"t1_1": 1}), ("t1_3", 1, 1, {})], "Test 1 failed - wrong map counts"
+        assert report["overlaps"] == [{"maps": ["t1_0","t1_1"], "rows": 1}, {"maps": ["t1_1","t1_2"], "rows": 1}], "Test 1 failed - wrong overlaps"
+        assert list(df.columns) == ['A','B'], "Test 1 failed - df changed"
+
+    def test_2(self):
+        """
+        test that invalid maps are reported, and that the other maps are still explained
+        """
+        df = pd.DataFrame.from_dict({'A': ['a','d','a'], 'B': ['b','e','y']})
+        mapping = [{"key":"A","logic":"equals","value":"a","assign_to":"one"}, {"key":"Z","logic":"equals","value":"a","assign_to":"two"}]
+        report = CustomDFAssigner("t1").explain(df,mapping)
+        assert report["maps"][1]["invalid"], "Test 2 failed - invalid map not reported"
+        assert (report["maps"][0]["matched"], report["maps"][0]["wins"]) == (2, 2), "Test 2 failed - wrong counts"
+
+    def test_3(self):
+        """
+        test the overlaps counted on packed bitsets against counting them row by row, with and without flipped bitsets
+        """
+        masks = [[i % 2 == 0 for i in range(150)], [i % 3 == 0 for i in range(150)], [i % 5 != 0 for i in range(150)], [i > 140 for i in range(150)]]
+        flipped = [False, False, True, False]
+        owners, positions, words, sizes = [], [], [], []
+        for index, mask in enumerate(masks):
+            word_positions, word_values = pack_mask([not row for row in mask] if flipped[index] else mask)
+            owners += [index] * len(word_positions)
+            positions += list(word_positions)
+            words += list(word_values)
+            sizes.append(sum(bin(int(word)).count("1") for word in word_values))
+        found = mask_overlaps(pd.Series(owners, dtype="int64").to_numpy(), pd.Series(positions, dtype="int64").to_numpy(), pd.Series(words, dtype="uint64").to_numpy(), sizes, flipped, 150)
+        expected = [(i, j, sum(a and b for a, b in zip(masks[i], masks[j]))) for i in range(0, 4) for j in range(i + 1, 4)]
+        assert [tuple(int(value) for value in pair) for pair in zip(*found)] == [pair for pair in expected if pair[2] > 0], "Test 3 failed - wrong overlaps"
+
+class Test_query_order():
+    """
+    Test the cost based order the predicates of a map are run in
+    """
+    def test_1(self):
+        """
+        test that a cheap selective equals runs before a contains that matches most rows
+        """
+        df = pd.DataFrame.from_dict({'A': ['some longer text %d' % i for i in range(3000)], 'B': ['b%d' % (i % 300) for i in range(3000)]})
+        queries = [{"key":"A","logic":"contains","value":"text"}, {"key":"B","logic":"equals","value":"b7"}]
+        assigner = CustomDFAssigner("t1")
+        assigner.column_cache.bind(df)
+        assert assigner.order_queries(df, queries) == queries[::-1], "Test 1 failed - wrong order"
+
+    def test_2(self):
+        """
+        test that running the predicates on the narrowing rows gives the same rows as checking them all
+        """
+        df = pd.DataFrame.from_dict({'A': ['some longer text %d' % i for i in range(3000)], 'B': ['b%d' % (i % 300) for i in range(3000)]})
+        mapping = [{"key":"A","logic":"contains","value":"text 1","assign_to":"test",
+                    "associated_query":[{"key":"B","logic":"equals","value":["B7","b10"]},{"key":"A","logic":"not_contains","value":"9"}]}]
+        expected = [("test" if "text 1" in a and b in ["b7","b10"] and "9" not in a else "unknown") for a, b in zip(df["A"], df["B"])]
+        updated = CustomDFAssigner("t1").custom_assignment_processor(df,mapping)
+        assert list(updated["new_col"]) == expected, "Test 2 failed - wrong rows assigned"
+
+class Test_matchers():
+    """
+    Test the multi pattern matchers used for contains and not_contains
+    """
+    def test_1(self):
+        """
+        test that every pattern in a string is found, including overlapping ones
+        """
+        matcher = AhoCorasick(["he","she","his","hers",""])
+        found = set(matcher.patterns[i] for i in matcher.search("ushers"))
+        assert found == {"he","she","hers",""}, "Test 1 failed - wrong patterns found"
+
+    def test_2(self):
+        """
+        test that contains maps give the same result with and without the matcher
+        """
+        df = pd.DataFrame.from_dict({'A': ['abc','BCD',None,'xyz','cab']*4, 'B': ['b','e','y','b','q']*4})
+        mapping = [{"key":"A","logic":"contains","value":value,"assign_to":value} for value in ["z","bc","ab","q","w","k","v","u"]]
+        mapping.append({"key":"B","logic":"equals","value":"b","assign_to":"not a","associated_query":[{"key":"A","logic":"not_contains","value":["ab","k"]}]})
+        map_set = CompiledMapSet(mapping)
+        assert "A" in map_set.matchers, "Test 2 failed - matcher not built"
+        assigner = CustomDFAssigner("t1")
+        assigner.column_cache.bind(df)
+        assert assigner.use_matcher(df, "A", map_set.matchers["A"]), "Test 2 failed - matcher not used"
+        updated = assigner.custom_assignment_processor(df.copy(),mapping)
+        assigner.multi_pattern = False
+        expected = assigner.custom_assignment_processor(df.copy(),mapping)
+        assert list(updated["map_id"]) == list(expected["map_id"]) == ["t1_1","t1_1","unknown","t1_0","t1_2"]*4, "Test 2 failed - wrong map id"
+
+    def test_3(self):
+        """
+        test that starts_with maps on the same key keep first match wins
+        """
+        df = pd.DataFrame.from_dict({'A': ['abc','Abd','b',None,'ax'], 'B': ['b','e','y','w','q']})
+        mapping = [{"key":"A","logic":"starts_with","value":"ab","assign_to":"ab"},
+                   {"key":"A","logic":"starts_with","value":["a","b"],"assign_to":"a or b"},
+                   {"key":"A","logic":"starts_with","value":"abd","assign_to":"abd"}]
+        singles, groups = CompiledMapSet(mapping).dispatch([0,1,2])
+        assert singles == [] and list(groups) == [("starts_with", "A")], "Test 3 failed - maps not grouped"
+        updated = CustomDFAssigner("t1").custom_assignment_processor(df,mapping)
+        assert list(updated["map_id"]) == ["t1_0","t1_0","t1_1","unknown","t1_1"], "Test 3 failed - wrong map id"
+
+    def test_4(self):
+        """
+        test that the matcher is skipped on a column with as many distinct values as rows, where checking rows per value is cheaper
+        """
+        df = pd.DataFrame.from_dict({'A': [f"row {i} abc" for i in range(100)]})
+        mapping = [{"key":"A","logic":"contains","value":value,"assign_to":value} for value in ["z","bc","ab","q","w","k","v","u"]]
+        map_set = CompiledMapSet(mapping)
+        assigner = CustomDFAssigner("t1")
+        assigner.column_cache.bind(df)
+        assert not assigner.use_matcher(df, "A", map_set.matchers["A"]), "Test 4 failed - matcher used"
+        updated = assigner.custom_assignment_processor(df.copy(),mapping)
+        assert set(updated["map_id"]) == {"t1_1"}, "Test 4 failed - wrong map id"
+
+class Test_categorical():
+    """
+    Test that key columns evaluated on their distinct values give the same result as the string path
+    """
+    def test_1(self):
+        """
+        test that categorical key columns give the same df as string columns
+        """
+        df = pd.DataFrame.from_dict({'A': ['a','A',None,'x'], 'B': ['b','e','y','b'], 'C': ['c','f','z','zz']})
+        mapping = json.loads(open("./unit_test_mappings/t4.json","r").read()) + json.loads(open("./unit_test_mappings/t3.json","r").read())
+        expected = CustomDFAssigner("t4").custom_assignment_processor(df.copy(),mapping)
+        updated = CustomDFAssigner("t4").custom_assignment_processor(df.astype("category"),mapping)
+        assert list(updated["map_id"]) == list(expected["map_id"]) == ["t4_1","t4_1","t4_0","t4_0"], "Test 1 failed - wrong map id"
+
+    def test_2(self):
+        """
+        test that string key columns can be evaluated on their distinct values, missing values included
+        """
+        df = pd.DataFrame.from_dict({'A': ['a','A',None,'x'], 'B': ['b','e','y','b']})
+        mapping = [{"key":"A","logic":"not_equals","value":"x","assign_to":"not x","associated_query":[{"key":"B","logic":"not_contains","value":"e"}]}]
+        assigner = CustomDFAssigner("t1")
+        assigner.categorical = True
+        updated = assigner.custom_assignment_processor(df,mapping)
+        assert list(updated["new_col"]) == ["not x","unknown","not x","unknown"], "Test 2 failed - wrong group"
+
+class Test_load_map_set():
+    """
+    Test the function 'load_map_set' and the compiled map sets it caches
+    """
+    def test_1(self):
+        """
+        test that an unchanged map file is only compiled once
+        """
+        assert load_map_set("./unit_test_mappings/t4.json") is load_map_set("./unit_test_mappings/t4.json"), "Test 1 failed - map set was rebuilt"
+
+    def test_2(self):
+        """
+        test that the map set is rebuilt when the file changes
+        """
+        path = os.path.join(tempfile.mkdtemp(), "env.json")
+        with open(path, "w") as f:
+            json.dump([{"key":"A","logic":"equals","value":"a","assign_to":"test"}], f)
+        first = load_map_set(path)
+        with open(path, "w") as f:
+            json.dump([{"key":"A","logic":"equals","value":"d","assign_to":"test"}], f)
+        os.utime(path, ns=(first.mtime + 1, first.mtime + 1))
+        second = load_map_set(path)
+        assert second is not first, "Test 2 failed - stale map set returned"
+        assert second.maps[0]["value"] == "d", "Test 2 failed - wrong value"
+
+    def test_3(self):
+        """
+        test that values are normalized without changing the loaded maps
+        """
+        maps = [{"key":"A","logic":"Equals","value":[" A ","D"],"assign_to":"test"}]
+        map_set = CompiledMapSet(maps)
+        assert map_set.maps[0]["logic"] == "equals", "Test 3 failed - logic not normalized"
+        assert map_set.maps[0]["value"] == ["a","d"], "Test 3 failed - value not normalized"
+        assert maps[0]["value"] == [" A ","D"], "Test 3 failed - loaded map was changed"
+
+    def test_4(self):
+        """
+        test that post run maps get the map id of their position in the file
+        """
+        df = pd.DataFrame.from_dict({'A': ['a','d','x'], 'B': ['b','e','y'], 'C': ['c','f','z']})
+        mapping = [{"key":"A","logic":"equals","value":"x","assign_to":"test"},
+                   {"key":"A","logic":"equals","value":"a","assign_to":"test","post_run":"L1"}]
+        updated = CustomDFAssigner("t1").custom_assignment_processor(df,mapping)
+        assert list(updated["map_id"]) == ["t1_1","unknown","t1_0"], "Test 4 failed - wrong map id"
+
+class Test_column_cache():
+    """
+    Test the lowercased column cache used by 'custom_assignment_processor'
+    """
+    def test_1(self):
+        """
+        test that each key column is only lowercased once per run
+        """
+        df = pd.DataFrame.from_dict({'A': ['a','d','x'], 'B': ['b','e','y'], 'C': ['c','f','z']})
+        mapping = json.loads(open("./unit_test_mappings/t4.json","r").read())
+        assigner = CustomDFAssigner("t4")
+        assigner.custom_assignment_processor(df,mapping)
+        assert assigner.column_cache.stats() == {"hits": 2, "misses": 3}, "Test 1 failed - wrong hit/miss counts"
+
+    def test_2(self):
+        """
+        test that the cache is dropped when a new frame is bound
+        """
+        cache = ColumnCache()
+        df = pd.DataFrame.from_dict({'A': ['A','D']})
+        cache.bind(df)
+        assert list(cache.lower(df, "A")) == ['a','d'], "Test 2 failed - column not lowercased"
+        other = pd.DataFrame.from_dict({'A': ['X','Y']})
+        cache.bind(other)
+        assert list(cache.lower(other, "A")) == ['x','y'], "Test 2 failed - stale column returned"
+        assert cache.stats() == {"hits": 0, "misses": 1}, "Test 2 failed - counts not reset"
+
+class Test_parallel_assignment_processor():
+    """
+    Test the method 'parallel_assignment_processor' against 'custom_assignment_processor'
+    """
+    def test_1(self):
+        """
+        test that running partitions in worker processes gives the same df as a serial run
+        """
+        df = pd.DataFrame.from_dict({'A': ['a','d','x','a','b']*3, 'B': ['b','e','y','k','z']*3, 'C': ['c','f','z','q','q']*3, 'D': range(15)})
+        mapping = json.loads(open("./unit_test_mappings/t6.json","r").read())
+        expected = CustomDFAssigner("t6").custom_assignment_processor(df.copy(),mapping)
+        updated = CustomDFAssigner("t6").parallel_assignment_processor(df.copy(),mapping,workers=2,partition_size=4)
+        assert updated.astype(str).equals(expected.astype(str)), "Test 1 failed - result differs from serial run"
+
+    def test_2(self):
+        """
+        test that start_processing can run in parallel, including the additional check
+        """
+        df = pd.DataFrame.from_dict({'A': ['a','d','x']*4, 'B': ['b','e','y']*4, 'C': ['c','f','z']*4})
+        updated = CustomDFAssigner("t1",maps_loc="./unit_test_mappings/").start_processing(df,True,workers=2,partition_size=5)
+        assert list(updated["map_id"]) == ["t1_0","extra_0","unknown"]*4, "Test 2 failed - wrong map id"
+
+class Test_profile():
+    """
+    Test the per map and per level report of runs made with a RunProfile
+    """
+    def test_1(self):
+        """
+        test that start_processing returns a report of each map set it ran
+        """
+        df = pd.DataFrame.from_dict({'A': ['a','d','x'], 'B': ['b','e','y'], 'C': ['c','f','z']})
+        updated, report = CustomDFAssigner("t1",maps_loc="./unit_test_mappings/").start_processing(df,True,profile=True)
+        assert list(updated["map_id"]) == ["t1_0","extra_0","unknown"], "Test 1 failed - wrong map id"
+        assert [run["env"] for run in report["runs"]] == ["t1","extra"], "Test 1 failed - wrong runs"
+        stats = report["runs"][1]["maps"]["extra_0"]
+        assert (stats["rows_in"], stats["rows_matched"], stats["rows_assigned"], stats["evaluations"]) == (2, 1, 1, 1), "Test 1 failed - wrong map stats"
+
+    def test_2(self):
+        """
+        test that grouped maps are counted as if the maps ran one after the other
+        """
+        df = pd.DataFrame.from_dict({'A': ['a','D','x','q'], 'B': ['b','e','y','w']})
+        mapping = json.loads(open("./unit_test_mappings/dispatch/t1.json","r").read())
+        assigner = CustomDFAssigner("t1")
+        assigner.profile = RunProfile()
+        assigner.custom_assignment_processor(df,mapping)
+        run = assigner.profile.report()["runs"][0]
+        counts = [(run["maps"][map_id]["rows_in"], run["maps"][map_id]["rows_matched"], run["maps"][map_id]["rows_assigned"]) for map_id in ["t1_0","t1_1","t1_2","t1_3"]]
+        assert counts == [(4, 1, 1), (3, 1, 1), (2, 0, 0), (2, 1, 1)], "Test 2 failed - wrong row counts"
+        assert [run["maps"][map_id]["grouped"] for map_id in ["t1_0","t1_1"]] == [False, True], "Test 2 failed - wrong grouping"
+        assert run["evaluations"] == 2, "Test 2 failed - wrong evaluation count"
+
+    def test_3(self):
+        """
+        test that the reports of partitions run in worker processes add up to the report of a serial run
+        """
+        df = pd.DataFrame.from_dict({'A': ['a','d','x','a','b']*3, 'B': ['b','e','y','k','z']*3, 'C': ['c','f','z','q','q']*3})
+        serial = CustomDFAssigner("t6",maps_loc="./unit_test_mappings/").start_processing(df.copy(),profile=True)[1]["runs"][0]
+        parallel = CustomDFAssigner("t6",maps_loc="./unit_test_mappings/").start_processing(df.copy(),workers=2,partition_size=4,profile=True)[1]["runs"][0]
+        counts = lambda run: [(level["level"], level["rows_in"], level["rows_assigned"]) for level in run["levels"]]
+        assert counts(parallel) == counts(serial) == [("default", 15, 6), ("L1", 9, 0), ("L2", 9, 3)], "Test 3 failed - wrong level counts"
+        assert parallel["maps"]["t6_0"]["rows_matched"] == 3, "Test 3 failed - wrong map counts"
+
+    def test_4(self):
+        """
+        test that a predicate shared by several maps is evaluated once and the reuses are reported as saved
+        """
+        df = pd.DataFrame.from_dict({'A': ['ab','ad','x'], 'B': ['b','b','y']})
+        mapping = [{"key":"A","logic":"contains","value":value,"assign_to":value,
+                    "associated_query":[{"key":"B","logic":"equals","value":"B"}]} for value in ["d","a","x"]]
+        assigner = CustomDFAssigner("t1")
+        assigner.profile = RunProfile()
+        updated = assigner.custom_assignment_processor(df,mapping)
+        assert list(updated["map_id"]) == ["t1_1","t1_0","unknown"], "Test 4 failed - wrong map id"
+        run = assigner.profile.report()["runs"][0]
+        assert (run["evaluations"], run["evaluations_saved"]) == (4, 2), "Test 4 failed - shared predicate evaluated again"
+
+    def test_5(self):
+        """
+        test that the Flask app only profiles runs that ask for it, and only those show at /metrics
+        """
+        import app
+        df = pd.DataFrame.from_dict({'A': ['a','d','x'], 'B': ['b','e','y'], 'C': ['c','f','z']})
+        app.set_data_frame(df)
+        client = app.app.test_client()
+        mapping = [{"key":"A","logic":"equals","value":"a","assign_to":"test"}]
+        client.post("/run_mapping?profile=1", json=mapping).data
+        assert client.get("/metrics").json["runs"][0]["maps"]["API_0"]["rows_matched"] == 1, "Test 5 failed - run not profiled"
+        client.post("/run_mapping", json=mapping + mapping).data
+        assert list(client.get("/metrics").json["runs"][0]["maps"]) == ["API_0"], "Test 5 failed - plain run profiled"
+
+    def test_6(self):
+        """
+        test that the reports of partitions are merged when a partition assigns all its rows before the later levels
+        """
+        df = pd.DataFrame.from_dict({'A': ['a']*4 + ['b']*4})
+        mapping = [{"key":"A","logic":"equals","value":"a","assign_to":"g1"},
+                   {"key":"A","logic":"equals","value":"b","assign_to":"g2","post_run":"L1"}]
+        with tempfile.TemporaryDirectory() as folder:
+            with open(os.path.join(folder, "t1.json"), "w") as f:
+                json.dump(mapping, f)
+            serial = CustomDFAssigner("t1",maps_loc=folder).start_processing(df.copy(),profile=True)
+            parallel = CustomDFAssigner("t1",maps_loc=folder).start_processing(df.copy(),workers=2,partition_size=4,profile=True)
+        assert parallel is not None and list(parallel[0]["map_id"]) == list(serial[0]["map_id"]) == ["t1_0"]*4 + ["t1_1"]*4, "Test 6 failed - wrong map id"
+        counts = lambda run: [(level["level"], level["rows_in"], level["rows_assigned"]) for level in run["levels"]]
+        assert counts(parallel[1]["runs"][0]) == counts(serial[1]["runs"][0]) == [("default", 8, 4), ("L1", 4, 4)], "Test 6 failed - wrong level counts"
+        assert parallel[1]["runs"][0]["maps"]["t1_1"]["rows_assigned"] == 4, "Test 6 failed - wrong map counts"
+
 class Test_map_validator():
     """
     Test the method 'map_validator' for valid and invalid scenarios
@@ -424,6 +1146,30 @@ class Test_map_validator():
         response = CustomDFAssigner("t13", maps_loc="./unit_test_mappings/map_validator/").map_validator(df)
         assert response == 'Maps given are valid', "Test 16 failed - mapping is valid"
 
+    def test_17(self):
+        """
+        test that conflicts are reported in the same order as comparing every pair of maps
+        """
+        df = pd.DataFrame.from_dict({'A': ['a','d','x'], 'AB': ['b','e','y']})
+        mapping = [
+            {"key":"A","logic":"contains","value":"ab","assign_to":"one"},
+            {"key":"A","logic":"equals","value":"xab","assign_to":"two"},
+            {"key":"AB","logic":"equals","value":["x","ab"],"assign_to":"three"},
+            {"key":"AB","logic":"equals","value":["b"],"assign_to":"four"},
+        ]
+        conflicts = [(i, j) for i in range(0, 3) for j in range(i + 1, 4)
+                     if mapping[i]['value'] in mapping[j]['value'] and mapping[i]['key'] in mapping[j]['key']]
+        assert find_conflicts(mapping) == conflicts == [(0, 1), (0, 2)], "Test 17 failed - wrong conflicts"
+        assert CustomDFAssigner("API").map_validator(df, mapping) is None, "Test 17 failed - conflict not caught"
+
+    def test_18(self):
+        """
+        test that a list value before a string value still fails validation like the pairwise check
+        """
+        mapping = [{"key":"A","logic":"equals","value":["a"],"assign_to":"one"}, {"key":"A","logic":"equals","value":"b","assign_to":"two"}]
+        with pytest.raises(TypeError):
+            find_conflicts(mapping)
+
 class Test_duplicate_mappings_check():
     """
     Test the method 'duplicate_mappings_check' for valid and invalid scenarios
@@ -442,6 +1188,48 @@ class Test_duplicate_mappings_check():
         response = CustomDFAssigner("t1").duplicate_mappings_check("./unit_test_mappings/")
         assert response is None, "test failed - should be  duplicates"
 
+    def test_3(self, capsys):
+        """
+        Test that maps differing only in case, field order or list order are duplicates, within a file too
+        """
+        with tempfile.TemporaryDirectory() as folder:
+            maps = {
+                "a.json": [{"key":"A","logic":"equals","value":["x","Y"],"assign_to":"test"}, {"key":"B","logic":"equals","value":"b","assign_to":"test"}],
+                "b.json": [{"assign_to":"test","value":["y","x"],"logic":"Equals","key":"A"}, {"key":"B","logic":"equals","value":"b","assign_to":"other"}, {"logic":"equals","key":"B","value":"B","assign_to":"test"}],
+                "notes": [],
+            }
+            for fn, mapping in maps.items():
+                with open(os.path.join(folder, fn), "w") as f:
+                    f.write(json.dumps(mapping))
+            response = CustomDFAssigner("t1").duplicate_mappings_check(folder + "/")
+        assert response is None, "test failed - should be duplicates"
+        assert "['a_0 and b_0', 'a_1 and b_2']" in capsys.readouterr().err, "test failed - wrong duplicates"
+
+    def test_4(self):
+        """
+        Test that saved fingerprints are reused for unchanged files and worked out again for changed ones
+        """
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "a.json")
+            cache_path = os.path.join(folder, "fingerprints.cache")
+            with open(path, "w") as f:
+                f.write(json.dumps([{"key":"A","logic":"equals","value":"a","assign_to":"test"}]))
+            assert CustomDFAssigner("t1").duplicate_mappings_check(folder + "/", cache_path) == 'No duplicates found', "test failed - no duplicates expected"
+            saved = json.loads(open(cache_path, "r").read())
+            assert list(saved) == [os.path.abspath(path)], "test failed - fingerprints not saved"
+            with open(path, "w") as f:
+                f.write(json.dumps([{"key":"A","logic":"equals","value":"a","assign_to":"test"}]*2))
+            assert CustomDFAssigner("t1").duplicate_mappings_check(folder + "/", cache_path) is None, "test failed - changed file not checked again"
+
+    def test_5(self):
+        """
+        Test that a map with a logic the engine rejects isn't a duplicate of a valid map it would normalize to
+        """
+        with tempfile.TemporaryDirectory() as folder:
+            with open(os.path.join(folder, "a.json"), "w") as f:
+                f.write(json.dumps([{"key":"A","logic":"equals","value":"a","assign_to":"test"}, {"key":"A","logic":" equals","value":"a","assign_to":"test"}]))
+            assert CustomDFAssigner("t1").duplicate_mappings_check(folder + "/") == 'No duplicates found', "test failed - invalid map reported as a duplicate"
+
 class Test_print_mapping():
     """
     Test the method 'print_mapping' for valid and invalid scenarios
@@ -491,3 +1279,56 @@ class Test_print_mappings():
         """
         response = CustomDFAssigner("t1", maps_loc="./unit_test_mappings/").print_mappings(["t1_100","t1_0"])
         assert ["Error Finding This Map"] in response, "Error printing mappings"
+
+class Test_map_registry():
+    """
+    Test the map directory index used to find map files and map ids
+    """
+    def test_1(self):
+        """
+        test that envs and map ids are found case insensitively and maps are returned as copies
+        """
+        registry = MapRegistry.get("./unit_test_mappings/")
+        assert registry is MapRegistry.get("./unit_test_mappings"), "Test 1 failed - registry not shared"
+        assert os.path.basename(registry.path("T1")) == "t1.json", "Test 1 failed - wrong path"
+        assert registry.path("missing") is None, "Test 1 failed - missing env found"
+        mapping = registry.lookup("T4_2")
+        mapping["associated_query"].append("changed")
+        assert registry.lookup("t4_2")["associated_query"] == [{"key":"B","logic":"not_equals","value":["b","y"]}], "Test 1 failed - cached map changed"
+
+    def test_2(self):
+        """
+        test that added and changed files are picked up, including env names with underscores
+        """
+        folder = tempfile.mkdtemp()
+        registry = MapRegistry.get(folder)
+        assert registry.path("my_env") is None, "Test 2 failed - env found in empty folder"
+        path = os.path.join(folder, "My_Env.json")
+        with open(path, "w") as f:
+            json.dump([{"key":"A","logic":"equals","value":"a","assign_to":"test"}], f)
+        assert registry.lookup("my_env_0")["value"] == "a", "Test 2 failed - added file not found"
+        with open(path, "w") as f:
+            json.dump([{"key":"A","logic":"equals","value":"a","assign_to":"test"}, {"key":"A","logic":"equals","value":"d","assign_to":"test"}], f)
+        response = CustomDFAssigner("my_env", maps_loc=folder).print_mappings(["my_env_1", "MY_ENV_0"])
+        assert [mapping["value"] for mapping in response] == ["d", "a"], "Test 2 failed - changed file not read again"
+
+class Test_benchmark():
+    """
+    Test the data and map set generators used by the benchmarks
+    """
+    def test_1(self):
+        """
+        test that the generated df has the requested shape and cardinality
+        """
+        df = benchmark.generate_frame(rows=500, columns=3, cardinality=20, length=12)
+        assert df.shape == (500, 3), "Test 1 failed - wrong shape"
+        assert df["C0"].nunique() <= 20, "Test 1 failed - wrong cardinality"
+
+    def test_2(self):
+        """
+        test that every generated map can be run against the generated df
+        """
+        df = benchmark.generate_frame(rows=500, columns=3, cardinality=20, length=12)
+        mapping = benchmark.generate_map_set(df, maps=30, list_size=2, depth=2, post_run=2)
+        assert CompiledMapSet(mapping).invalid_maps(list(df.columns), ["L1", "L2"]) == [], "Test 2 failed - invalid maps generated"
+        assert all(len(m["associated_query"]) == 2 and len(m["value"]) == 2 for m in mapping), "Test 2 failed - wrong map shape"